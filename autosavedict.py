@@ -1,80 +1,276 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import json
-from typing import overload
+import logging
+import operator
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import overload, Optional, List, Callable, Tuple, NamedTuple, Any, Deque, Collection
 
 from typing_extensions import SupportsIndex
 
-
-def is_jsonable(item):
-    try:
-        json.dumps(item)
-        return True
-    except TypeError or OverflowError:
-        return False
+import datacodecs
 
 
 class NotSavableError(Exception):
     pass
 
 
-def _recurse_convert_list(callback, raw: list) -> list:
-    converted = CallbackOnUpdateList(callback)
-    for v in raw:
-        if isinstance(v, list):
-            converted.append(_recurse_convert_list(callback, v))
-        elif isinstance(v, dict):
-            converted.append(_recurse_convert_dict(callback, v))
-        else:
-            converted.append(v)
-    return converted
-
-def _recurse_convert_dict(callback, raw: dict) -> dict:
-    converted = CallbackOnUpdateDict(callback)
-    for k, v in raw.items():
-        if isinstance(v, list):
-            converted[k] = _recurse_convert_list(callback, v)
-        elif isinstance(v, dict):
-            converted[k] = _recurse_convert_dict(callback, v)
+class Change(NamedTuple):
+    """
+    A change made to an AutoSavingDict, as passed to its subscribers.
+
+    path is the keys leading from the root down to what changed. For operations on a whole list or dict (append,
+    remove, clear, reverse and replace), it leads to the list or dict itself. List indexes in it are never negative.
+
+    old and new are plain copies taken when the change was made, so later changes don't show up in them. old is None if
+    there wasn't an old value, and new is None if the value was deleted. remove passes the removed value as both.
+    rollback passes None as both, since what was undone can be anywhere in the data.
+    """
+    path: tuple
+    op: str
+    old: Any
+    new: Any
+
+
+_JSON_SCALARS = (str, int, float, bool, type(None))
+# Stands in for a top-level key that a batch backed up before it existed
+_ABSENT = object()
+# The least time to wait before trying a failed save again, in seconds
+_FAILED_SAVE_RETRY_DELAY = 5
+
+
+def _convert(callback, v, parent, key=None):
+    """
+    Check that v can be saved in a json file, wrapping every dict and list in it along the way.
+
+    :raises NotSavableError: if v or anything in it can't be saved
+    """
+    if isinstance(v, _JSON_SCALARS):
+        return v
+    try:
+        return _wrap(callback, v, parent, key)
+    except RecursionError:
+        # Not shown in the message, since printing it would recurse just as deep
+        raise NotSavableError(f"This {type(v).__name__} contains itself or is nested too deeply, and cannot be saved "
+                              f"in a file.") from None
+
+
+def _wrap(callback, v, parent, key=None):
+    # Scalars are checked inline rather than with a call per item, which is where most of the time would go
+    if isinstance(v, dict):
+        converted = CallbackOnUpdateDict(callback, parent=parent, key=key)
+        for k, child in v.items():
+            if not isinstance(k, _JSON_SCALARS):
+                raise NotSavableError(f"Key {k} cannot be saved in a file, and will not be added.")
+            if not isinstance(child, _JSON_SCALARS):
+                child = _wrap(callback, child, converted, k)
+            dict.__setitem__(converted, k, child)
+        return converted
+    if isinstance(v, (list, tuple)):
+        converted = CallbackOnUpdateList(callback, parent=parent, key=key)
+        for child in v:
+            if not isinstance(child, _JSON_SCALARS):
+                child = _wrap(callback, child, converted)
+            list.append(converted, child)
+        return converted
+    raise NotSavableError(f"Object {v} cannot be saved in a file, and will not be added.")
+
+
+def _path_of(container) -> Optional[tuple]:
+    """
+    Find the keys leading from the root AutoSavingDict down to container.
+
+    :return: the path, or None if container is no longer part of an AutoSavingDict
+    """
+    path = []
+    while container.parent is not None:
+        parent = container.parent
+        if isinstance(parent, list):
+            for i, v in enumerate(parent):
+                if v is container:
+                    path.append(i)
+                    break
+            else:
+                return None
         else:
-            converted[k] = v
-    return converted
+            if dict.get(parent, container.key) is not container:
+                return None
+            path.append(container.key)
+        container = parent
+    if not isinstance(container, AutoSavingDict):
+        return None
+    return tuple(reversed(path))
+
+
+def _json_key(key):
+    # json.dump turns every dict key into a string, so replayed keys have to match
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, bool):
+        return json.dumps(key)
+    return str(key)
+
+
+def _apply_journal_entry(root: dict, path: list, op: str, key, value) -> None:
+    container = root
+    for k in path:
+        container = container[_json_key(k) if isinstance(container, dict) else k]
+    if isinstance(container, dict) and op in ("set", "del"):
+        key = _json_key(key)
+    if op == "set":
+        container[key] = value
+    elif op == "del":
+        del container[key]
+    elif op == "insert":
+        container.insert(key, value)
+    elif op == "append":
+        container.append(value)
+    elif op == "remove":
+        container.remove(value)
+    elif op == "clear":
+        container.clear()
+    elif op == "reverse":
+        container.reverse()
+    elif op == "replace":
+        container[:] = value
+    else:
+        raise ValueError(f"Unknown journal operation {op}")
+
+
+def _wrap_loaded(callback, v, parent, key=None):
+    """
+    Wrap a plain dict or list that a lazy load left as-is, now that it is being accessed. Dicts inside of it stay plain
+    until they are accessed in turn.
+    """
+    if type(v) is dict:
+        wrapped = CallbackOnUpdateDict(callback, parent=parent, key=key)
+        dict.update(wrapped, v)
+        wrapped._lazy = True
+    elif type(v) is list:
+        wrapped = CallbackOnUpdateList(callback, parent=parent, key=key)
+        list.extend(wrapped, [_wrap_loaded(callback, child, wrapped) for child in v])
+    else:
+        return v
+    return wrapped
+
+
+def _before_change(container) -> None:
+    """
+    Let any batch open on the AutoSavingDict that container is part of back up the top-level key container is under,
+    before container is changed.
+    """
+    root = getattr(container.callback, "__self__", None)
+    if not getattr(root, "_open_batches", None):
+        return
+    while container.parent is not root:
+        if container.parent is None:
+            return
+        container = container.parent
+    if dict.get(root, container.key) is container:
+        root._back_up(container.key)
+
+
+class _WrapOnAccessDict(dict):
+    """
+    A dict that may hold plain dicts and lists from a lazy load, and wraps them as they are accessed.
+
+    setdefault, pop and popitem go through __getitem__, __setitem__ and __delitem__, so what they return is wrapped and
+    the changes they make are saved.
+    """
+    callback: Callable
+    _lazy = False
+
+    def __getitem__(self, k):
+        v = super().__getitem__(k)
+        if self._lazy and (type(v) is dict or type(v) is list):
+            v = _wrap_loaded(self.callback, v, self, k)
+            dict.__setitem__(self, k, v)
+        return v
 
+    def get(self, k, default=None):
+        if k in self:
+            return self[k]
+        return default
 
-class CallbackOnUpdateDict(dict):
-    def __init__(self, callback, **kwargs):
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self[k] = default
+        return self[k]
+
+    def pop(self, k, *default):
+        if k not in self:
+            if default:
+                return default[0]
+            raise KeyError(k)
+        v = self[k]
+        del self[k]
+        return v
+
+    def popitem(self):
+        if not dict.__len__(self):
+            raise KeyError("popitem(): dictionary is empty")
+        k = next(reversed(dict.keys(self)))
+        return k, self.pop(k)
+
+    def values(self):
+        self._wrap_all()
+        return super().values()
+
+    def items(self):
+        self._wrap_all()
+        return super().items()
+
+    def _wrap_all(self) -> None:
+        if not self._lazy:
+            return
+        for k, v in list(dict.items(self)):
+            dict.__setitem__(self, k, _wrap_loaded(self.callback, v, self, k))
+        self._lazy = False
+
+
+class CallbackOnUpdateDict(_WrapOnAccessDict):
+    def __init__(self, callback, parent=None, key=None, **kwargs):
         super().__init__(**kwargs)
         self.callback = callback
+        self.parent = parent
+        self.key = key
 
     def __setitem__(self, k, v):
-        if not is_jsonable(v):
-            raise NotSavableError(f"Object {v} cannot be saved in a file, and will not be added.")
-        if isinstance(v, dict):
-            v = _recurse_convert_dict(self.callback, v)
-        if isinstance(v, list):
-            v = _recurse_convert_list(self.callback, v)
+        v = _convert(self.callback, v, self, k)
+        _before_change(self)
+        old = dict.get(self, k)
         super().__setitem__(k, v)
-        self.callback()
+        self.callback(self, "set", k, v, old)
 
     def __delitem__(self, v):
+        _before_change(self)
+        old = dict.get(self, v)
         super().__delitem__(v)
-        self.callback()
+        self.callback(self, "del", v, None, old)
 
     def clear(self) -> None:
+        _before_change(self)
+        old = dict(self)
         super().clear()
-        self.callback()
-
-    def popitem(self):
-        rtn = super().popitem()
-        self.callback()
-        return rtn
+        self.callback(self, "clear", None, None, old)
 
     def update(self, *args, **kwargs) -> None:
         raise NotImplementedError("Please use the other methods for this :)")
 
 
 class CallbackOnUpdateList(list):
-    def __init__(self, callback, *args):
+    def __init__(self, callback, *args, parent=None, key=None):
         super().__init__(*args)
         self.callback = callback
+        self.parent = parent
+        self.key = key
 
     @overload
     def __setitem__(self, i: SupportsIndex, o) -> None: ...
@@ -83,54 +279,74 @@ class CallbackOnUpdateList(list):
     def __setitem__(self, s: slice, o) -> None: ...
 
     def __setitem__(self, i: SupportsIndex, o) -> None:
-        if not is_jsonable(o):
-            raise NotSavableError(f"Object {o} cannot be saved in a file, and will not be added.")
-        if isinstance(o, dict):
-            o = _recurse_convert_dict(self.callback, o)
-        if isinstance(o, list):
-            o = _recurse_convert_list(self.callback, o)
+        if isinstance(i, slice):
+            o = [_convert(self.callback, v, self) for v in o]
+            _before_change(self)
+            old = list(self)
+            super().__setitem__(i, o)
+            self.callback(self, "replace", None, self, old)
+            return
+        o = _convert(self.callback, o, self)
+        _before_change(self)
+        old = super().__getitem__(i)
         super().__setitem__(i, o)
+        self.callback(self, "set", self._index(i), o, old)
 
     def __delitem__(self, i) -> None:
+        _before_change(self)
+        if isinstance(i, slice):
+            old = list(self)
+            super().__delitem__(i)
+            self.callback(self, "replace", None, self, old)
+            return
+        old = super().__getitem__(i)
+        index = self._index(i)
         super().__delitem__(i)
-        self.callback()
+        self.callback(self, "del", index, None, old)
 
     def clear(self) -> None:
+        _before_change(self)
+        old = list(self)
         super().clear()
-        self.callback()
+        self.callback(self, "clear", None, None, old)
 
     def append(self, __object):
-        if not is_jsonable(__object):
-            raise NotSavableError(f"Object {__object} cannot be saved in a file, and will not be added.")
-        if isinstance(__object, dict):
-            __object = _recurse_convert_dict(self.callback, __object)
-        if isinstance(__object, list):
-            __object = _recurse_convert_list(self.callback, __object)
+        __object = _convert(self.callback, __object, self)
+        _before_change(self)
         super().append(__object)
-        self.callback()
+        self.callback(self, "append", None, __object, None)
 
-    def pop(self, __index: SupportsIndex = ...):
+    def pop(self, __index: SupportsIndex = -1):
+        _before_change(self)
+        index = self._index(__index)
         rtn = super().pop(__index)
-        self.callback()
+        self.callback(self, "del", index, None, rtn)
         return rtn
 
     def insert(self, __index: SupportsIndex, __object):
-        if not is_jsonable(__object):
-            raise NotSavableError(f"Object {__object} cannot be saved in a file, and will not be added.")
-        if isinstance(__object, dict):
-            __object = _recurse_convert_dict(self.callback, __object)
-        if isinstance(__object, list):
-            __object = _recurse_convert_list(self.callback, __object)
+        __object = _convert(self.callback, __object, self)
+        _before_change(self)
+        # insert clamps indexes that are out of range rather than raising
+        index = min(max(self._index(__index), 0), len(self))
         super().insert(__index, __object)
-        self.callback()
+        self.callback(self, "insert", index, __object, None)
 
     def remove(self, __value):
+        _before_change(self)
         super().remove(__value)
-        self.callback()
+        self.callback(self, "remove", None, __value, __value)
 
     def reverse(self):
+        _before_change(self)
         super().reverse()
-        self.callback()
+        self.callback(self, "reverse", None, None, None)
+
+    def _index(self, i: SupportsIndex) -> int:
+        """
+        :return: i counted from the start of the list, if it counts from the end
+        """
+        i = operator.index(i)
+        return i + len(self) if i < 0 else i
 
     @overload
     def sort(self, *, key: None = ..., reverse: bool = ...) -> None: ...
@@ -138,65 +354,898 @@ class CallbackOnUpdateList(list):
     @overload
     def sort(self, *, key, reverse: bool = ...) -> None: ...
 
-    def sort(self, *, key: None = ..., reverse: bool = ...) -> None:
+    def sort(self, *, key: None = None, reverse: bool = False) -> None:
+        _before_change(self)
+        old = list(self)
         super().sort(key=key, reverse=reverse)
-        self.callback()
+        self.callback(self, "replace", None, self, old)
 
 
-class AutoSavingDict(dict):
-    def __init__(self, data_file_location: str):
+class AutoSavingDict(_WrapOnAccessDict):
+    def __init__(self, data_file_location: str, write_behind_interval: Optional[float] = None, journal: bool = False,
+                 journal_compact_threshold: int = 1000, threaded_writes: bool = False, lazy: bool = False,
+                 codec: str = "json", memory_map: bool = False):
+        """
+        :param data_file_location: the json file to keep in sync with this dict
+        :param write_behind_interval: if set, a mutation only marks this dict as dirty, and the file is rewritten at
+        most once every write_behind_interval seconds (or sooner with flush()). Otherwise, every mutation rewrites the
+        file immediately.
+        :param journal: if True, mutations are appended to a journal file next to the data file instead of rewriting
+        the whole data file. The journal is compacted into the data file every journal_compact_threshold entries.
+        :param threaded_writes: if True, saves triggered from the event loop copy the data and leave serializing and
+        writing it to a background thread.
+        :param lazy: if True, the dicts and lists loaded from the file are only wrapped to save changes once they are
+        accessed, instead of all at once.
+        :param codec: the format to save the data in, from datacodecs.codec_options. Existing files are read in
+        whatever format they were saved in.
+        :param memory_map: if True, files are decoded from a memory-mapped view instead of being read into memory
+        first. This only saves memory for codecs that can read from a buffer, like msgpack.
+        """
         self.data_file_location = data_file_location
+        self.journal_file_location = data_file_location + ".journal"
+        self.write_behind_interval = write_behind_interval
+        self.journal = journal
+        self.journal_compact_threshold = journal_compact_threshold
+        self.threaded_writes = threaded_writes
+        self.codec = datacodecs.get_codec(codec)
+        self.memory_map = memory_map
+        if journal and not isinstance(self.codec, datacodecs.JsonCodec):
+            raise ValueError("Journaling is only supported for json codecs.")
+        self.writes_coalesced = 0
+        self.parent = None
+        self.callback = self._on_change
+        self.lazy = lazy
+        self._lazy = lazy
+        self._file = self._make_writer()
+        self._dirty = False
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Saves from flush_async waiting for the save thread, oldest first, and the future of the newest one
+        self._queued_saves: Deque[Tuple[Callable[[], None], concurrent.futures.Future]] = collections.deque()
+        self._last_save: Optional[concurrent.futures.Future] = None
+        # Jobs from flush_async that failed on the save thread, for the event loop to deal with
+        self._failed_saves: Deque[Callable[[], None]] = collections.deque()
+        self._pending_journal: List[str] = []
+        self._journal_length = 0
+        self._batch_depth = 0
+        self._batch_changed = False
+        # The backups of each open batch, outermost first
+        self._open_batches: List[dict] = []
+        self._saves = 0
+        self._blocking_total = 0.0
+        self._blocking_max = 0.0
+        self._blocking_last = 0.0
         self._prepped = False
-        super().__init__(**self._get_data())
+        self._subscribers: List[Tuple[tuple, Callable[[Change], None]]] = []
+        super().__init__()
+        if lazy:
+            dict.update(self, self._get_data())
+        else:
+            for k, v in self._get_data().items():
+                dict.__setitem__(self, k, _convert(self._on_change, v, self, k))
         self._prepped = True
+        if self._journal_length > 0 or (not self.journal and os.path.exists(self.journal_file_location)):
+            # Fold whatever was replayed into a fresh snapshot
+            self._journal_length = 0
+            self._file.write_snapshot(_snapshot(self))
 
     def __setitem__(self, k, v):
-        if not is_jsonable(v):
-            raise NotSavableError(f"Object {v} cannot be saved in a file, and will not be added.")
-        if isinstance(v, dict):
-            v = _recurse_convert_dict(self.update_data_file, v)
-        if isinstance(v, list):
-            v = _recurse_convert_list(self.update_data_file, v)
+        v = _convert(self._on_change, v, self, k)
+        self._back_up(k)
+        old = dict.get(self, k)
         super().__setitem__(k, v)
-        self.update_data_file()
+        self._on_change(self, "set", k, v, old)
+
+    def _make_writer(self) -> "_DataFileWriter":
+        return _DataFileWriter(self.data_file_location, self.journal_file_location, self.codec)
 
     def __delitem__(self, v):
+        self._back_up(v)
+        old = dict.get(self, v)
         super().__delitem__(v)
-        self.update_data_file()
+        self._on_change(self, "del", v, None, old)
 
     def clear(self) -> None:
+        for k in list(dict.keys(self)):
+            self._back_up(k)
+        old = dict(dict.items(self)) if self._subscribers else None
         super().clear()
-        self.update_data_file()
-
-    def popitem(self):
-        rtn = super().popitem()
-        self.update_data_file()
-        return rtn
+        self._on_change(self, "clear", None, None, old)
 
     def update(self, *args, **kwargs) -> None:
-        super().update(*args, **kwargs)
+        for k, v in dict(*args, **kwargs).items():
+            v = _convert(self._on_change, v, self, k)
+            self._back_up(k)
+            old = dict.get(self, k)
+            super().__setitem__(k, v)
+            self._record_change(self, "set", k, v)
+            self._publish(self, "set", k, v, old)
         self.update_data_file()
 
     def _get_data(self) -> dict:
         """
-        Save the contents of the json data_file to self.data.
+        Read the contents of the data_file, along with any journal entries made since it was written.
         """
         try:
-            with open(self.data_file_location, 'r') as file:
-                data_raw: dict = json.load(file)
-            return _recurse_convert_dict(self.update_data_file, data_raw)
+            data_raw, self._file.snapshot_digest = datacodecs.read_file(self.data_file_location, self.memory_map,
+                                                                        self.codec)
+            self._replay_journal(data_raw)
+            return data_raw
 
         except FileNotFoundError:
-            with open(self.data_file_location, 'w') as file:
-                # print("Making {}".format(self.data_file_location))
-                file.write("{}")
+            # print("Making {}".format(self.data_file_location))
+            self._file.write_snapshot({})
             return self._get_data()
 
+    def _replay_journal(self, data_raw: dict) -> None:
+        self._journal_length = 0
+        try:
+            with open(self.journal_file_location, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            return
+        if header.get("snapshot") != self._file.snapshot_digest:
+            # This journal was already folded into the snapshot before the last shutdown
+            return
+        for line in lines[1:]:
+            try:
+                path, op, key, value = json.loads(line)
+            except ValueError:
+                # A crash cut off the last entry while it was being written
+                break
+            _apply_journal_entry(data_raw, path, op, key, value)
+            self._journal_length += 1
+
+    def _on_change(self, container, op: str, key, value, old=None) -> None:
+        if not self._prepped:
+            return
+        self._record_change(container, op, key, value)
+        self._publish(container, op, key, value, old)
+        self.update_data_file()
+
+    def subscribe(self, prefix: tuple, callback: Callable[[Change], None]) -> Callable[[], None]:
+        """
+        Call callback with a Change whenever something at or under prefix changes, including when something above it is
+        replaced or removed.
+
+        The callback runs right after the change is made, before it is saved. Changes undone by a failed batch are
+        followed by a Change with the op "rollback" and an empty path.
+
+        :param prefix: the keys leading from the root down to the part of the data to watch. () watches everything.
+        :return: a function that cancels the subscription
+        """
+        subscription = (tuple(prefix), callback)
+        self._subscribers.append(subscription)
+
+        def unsubscribe():
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+
+        return unsubscribe
+
+    def _publish(self, container, op: str, key, value, old) -> None:
+        if not self._subscribers:
+            return
+        path = _path_of(container)
+        if path is None:
+            return
+        if op in ("set", "del", "insert"):
+            path += (key,)
+        if old is _UNLOADED:
+            old = None
+        self._notify(Change(path, op, _copy(old), _copy(value)))
+
+    def _notify(self, change: Change) -> None:
+        for prefix, callback in list(self._subscribers):
+            length = min(len(prefix), len(change.path))
+            if prefix[:length] != change.path[:length]:
+                continue
+            try:
+                callback(change)
+            except Exception:
+                logging.exception(f"Subscriber {callback} failed to handle {change}")
+
+    def _record_change(self, container, op: str, key, value) -> None:
+        if not self.journal:
+            return
+        path = _path_of(container)
+        if path is None:
+            return
+        self._pending_journal.append(json.dumps([path, op, key, value]))
+
     def update_data_file(self) -> None:
         """
-        Save the contents of self.data to the json data_file.
+        Save the contents of self.data to the json data_file, or schedule it to be saved if in write-behind mode.
         """
         if not self._prepped:
             return
-        with open(self.data_file_location, 'w') as file:
-            json.dump(self, file)
+        if self._batch_depth > 0:
+            self._batch_changed = True
+            return
+        if self.write_behind_interval is None and not self.threaded_writes:
+            self._timed_write(self._prepare_write())
+            return
+        if self._dirty:
+            self.writes_coalesced += 1
+            return
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Nothing to defer the write to, so just write through
+            self.flush()
+            return
+        self._schedule_flush(loop, self.write_behind_interval or 0)
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop, delay: float) -> None:
+        if self.threaded_writes:
+            self._flush_handle = loop.call_later(delay, lambda: loop.create_task(self.flush_async()))
+        else:
+            self._flush_handle = loop.call_later(delay, self.flush)
+
+    def flush(self) -> None:
+        """
+        Immediately save any changes that are waiting on the write-behind timer.
+
+        With threaded writes, this blocks until the save thread has caught up, including on saves started by
+        flush_async.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._last_save is not None:
+            # flush_async reports its own failures
+            concurrent.futures.wait([self._last_save])
+        self._restore_failed_saves()
+        if not self._dirty or self._batch_depth > 0:
+            return
+        self._dirty = False
+        self._timed_write(self._prepare_write())
+
+    async def flush_async(self) -> None:
+        """
+        Save any pending changes from the save thread, only blocking the event loop long enough to copy the data.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty or self._batch_depth > 0:
+            return
+        self._dirty = False
+        start = time.perf_counter()
+        saved = concurrent.futures.Future()
+        # The order of saves is settled here, since the submissions below can reach the save thread out of order
+        self._queued_saves.append((self._prepare_write(copy=True), saved))
+        self._last_save = saved
+        try:
+            _save_worker.submit(self._run_queued_save, block=False)
+        except queue.Full:
+            self._record_blocking_time(time.perf_counter() - start)
+            await asyncio.get_running_loop().run_in_executor(None, _save_worker.submit, self._run_queued_save)
+        else:
+            self._record_blocking_time(time.perf_counter() - start)
+        try:
+            await asyncio.wrap_future(saved)
+        finally:
+            self._restore_failed_saves()
+
+    def _run_queued_save(self) -> None:
+        """
+        Run the oldest save queued by flush_async. Runs on the save thread.
+        """
+        job, saved = self._queued_saves.popleft()
+        try:
+            job()
+        except BaseException as e:
+            self._failed_saves.append(job)
+            saved.set_exception(e)
+            raise
+        saved.set_result(None)
+
+    def _restore_failed_saves(self) -> None:
+        while self._failed_saves:
+            self._write_failed(self._failed_saves.popleft())
+
+    def _write_failed(self, job: Callable[[], None]) -> None:
+        """
+        Put back whatever a failed save took from the pending changes, so that a later save tries again.
+
+        :param job: the job from _prepare_write that failed
+        """
+        if self.journal:
+            # The journal entries it was writing are gone, so only a fresh snapshot has everything
+            self._journal_length = self.journal_compact_threshold
+        if self._dirty:
+            return
+        self._dirty = True
+        if self._flush_handle is None and (self.write_behind_interval is not None or self.threaded_writes):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # flush() will pick it up
+                return
+            self._schedule_flush(loop, max(self.write_behind_interval or 0, _FAILED_SAVE_RETRY_DELAY))
+
+    def batch(self) -> "_Batch":
+        """
+        Group several changes into a single save with `with data.batch():` or `async with data.batch():`.
+
+        Nothing is saved until the block exits. If the block raises, every change made inside of it is undone.
+        The async version also waits for the save to finish.
+        """
+        return _Batch(self)
+
+    def _end_batch(self) -> None:
+        if not self._batch_changed and not self._dirty:
+            return
+        self._batch_changed = False
+        if self._dirty and self._flush_handle is None:
+            # A flush came due during the batch and was held back
+            self._dirty = False
+        self.update_data_file()
+
+    def _back_up(self, key) -> None:
+        """
+        Remember what key held before the open batches first change it, so they can put it back if they fail.
+        """
+        if not self._open_batches or key in self._open_batches[-1]:
+            # A batch backs up everything the batches inside of it do
+            return
+        backup = _snapshot(dict.get(self, key, _ABSENT))
+        for batch_backup in self._open_batches:
+            batch_backup.setdefault(key, backup)
+
+    def _rollback(self, backup: dict, journal_mark: int) -> None:
+        """
+        :param backup: the top-level keys changed since the batch started, and what they held then
+        """
+        for k, v in backup.items():
+            if v is _ABSENT:
+                dict.pop(self, k, None)
+            elif self.lazy:
+                dict.__setitem__(self, k, v)
+                self._lazy = True
+            else:
+                dict.__setitem__(self, k, _convert(self._on_change, v, self, k))
+        del self._pending_journal[journal_mark:]
+        if self._batch_depth == 0:
+            self._batch_changed = False
+        if self._subscribers:
+            self._notify(Change((), "rollback", None, None))
+
+    def save_stats(self) -> dict:
+        """
+        :return: how many saves have been made and how long they blocked the event loop for, in seconds
+        """
+        return {
+            "saves": self._saves,
+            "writes_coalesced": self.writes_coalesced,
+            "bytes_written": self._file.bytes_written,
+            "blocking_total": self._blocking_total,
+            "blocking_max": self._blocking_max,
+            "blocking_last": self._blocking_last,
+            "queued": self.save_queue_depth(),
+        }
+
+    @staticmethod
+    def save_queue_depth() -> int:
+        """
+        :return: how many saves are waiting for the save thread, from every AutoSavingDict
+        """
+        return _save_worker.queued()
+
+    def _timed_write(self, job: Callable[[], None]) -> None:
+        start = time.perf_counter()
+        try:
+            if self.threaded_writes:
+                _save_worker.submit(job).result()
+            else:
+                job()
+        except Exception:
+            self._write_failed(job)
+            raise
+        self._record_blocking_time(time.perf_counter() - start)
+
+    def _record_blocking_time(self, elapsed: float) -> None:
+        self._saves += 1
+        self._blocking_total += elapsed
+        self._blocking_max = max(self._blocking_max, elapsed)
+        self._blocking_last = elapsed
+
+    def _prepare_write(self, copy: bool = False) -> Callable[[], None]:
+        """
+        Decide what the next save needs to write. Everything that reads this dict happens here, so the returned job can
+        safely run on the save thread.
+
+        :param copy: whether to copy the data, for jobs that will run after this dict may have changed again
+        """
+        if not self.journal or self._journal_length + len(self._pending_journal) >= self.journal_compact_threshold:
+            self._pending_journal = []
+            self._journal_length = 0
+            # Lazily loaded data has to be copied too, so json doesn't wrap everything while saving it
+            data = _snapshot(self) if copy or self.lazy else self
+            return functools.partial(self._file.write_snapshot, data)
+        entries = self._pending_journal
+        self._pending_journal = []
+        fresh = self._journal_length == 0
+        self._journal_length += len(entries)
+        return functools.partial(self._file.append_journal, entries, fresh)
+
+
+class _Batch:
+    """
+    Holds back saving an AutoSavingDict until the block exits, and undoes the block's changes if it raises.
+    """
+
+    def __init__(self, data: AutoSavingDict):
+        self.data = data
+        self._backup: Optional[dict] = None
+        self._journal_mark = 0
+
+    def __enter__(self) -> AutoSavingDict:
+        # Top-level keys are backed up as they are first changed, so starting a batch doesn't copy the whole dict
+        self._backup = {}
+        self._journal_mark = len(self.data._pending_journal)
+        self.data._open_batches.append(self._backup)
+        self.data._batch_depth += 1
+        return self.data
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        self.data._batch_depth -= 1
+        self.data._open_batches.remove(self._backup)
+        if exc_type is not None:
+            self.data._rollback(self._backup, self._journal_mark)
+        if self.data._batch_depth == 0:
+            self.data._end_batch()
+        return False
+
+    async def __aenter__(self) -> AutoSavingDict:
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> bool:
+        self.__exit__(exc_type, exc_val, exc_tb)
+        if self.data._batch_depth == 0:
+            await self.data.flush_async()
+        return False
+
+
+def _snapshot(value):
+    """
+    Copy the containers in value into plain dicts and lists, leaving everything else shared.
+
+    Plain dicts and lists are left over from a lazy load, and are never changed in place, so they can be shared too.
+    """
+    if type(value) is dict or type(value) is list:
+        return value
+    if isinstance(value, dict):
+        return {k: _snapshot(v) for k, v in dict.items(value)}
+    if isinstance(value, list):
+        return [_snapshot(v) for v in value]
+    return value
+
+
+def _copy(value):
+    """
+    Copy value like _snapshot does, also copying a plain dict or list itself, since the old values passed to callbacks
+    are shallow copies that can still hold live containers.
+    """
+    if type(value) is dict:
+        return {k: _snapshot(v) for k, v in value.items()}
+    if type(value) is list:
+        return [_snapshot(v) for v in value]
+    return _snapshot(value)
+
+
+def _atomic_write(location: str, raw: bytes) -> None:
+    temp_location = location + ".tmp"
+    with open(temp_location, 'wb') as file:
+        file.write(raw)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_location, location)
+
+
+class _DataFileWriter:
+    """
+    Does the file writing for an AutoSavingDict. Jobs for a single file are always run one at a time, in order.
+    """
+
+    def __init__(self, data_file_location: str, journal_file_location: str, codec):
+        self.data_file_location = data_file_location
+        self.journal_file_location = journal_file_location
+        self.codec = codec
+        self.snapshot_digest = ""
+        self.bytes_written = 0
+
+    def write_snapshot(self, data: dict) -> None:
+        """
+        Atomically replace the data file with data, then drop the journal that led up to it.
+        """
+        raw = self.codec.dumps(data)
+        _atomic_write(self.data_file_location, raw)
+        self.snapshot_digest = datacodecs.digest(raw)
+        self.bytes_written += len(raw)
+        if os.path.exists(self.journal_file_location):
+            os.remove(self.journal_file_location)
+
+    def append_journal(self, entries: List[str], fresh: bool) -> None:
+        if not entries:
+            return
+        if fresh:
+            # Tie a fresh journal to the snapshot it applies on top of
+            header = json.dumps({"snapshot": self.snapshot_digest}) + "\n"
+            mode = 'w'
+        else:
+            header = ""
+            mode = 'a'
+        text = header + "\n".join(entries) + "\n"
+        with open(self.journal_file_location, mode) as file:
+            file.write(text)
+        self.bytes_written += len(text)
+
+
+class _SaveWorker:
+    """
+    A single thread that runs save jobs in the order they were submitted.
+    """
+
+    def __init__(self, max_queued: int = 64):
+        self._queue: "queue.Queue[Tuple[Callable[[], None], concurrent.futures.Future]]" = queue.Queue(max_queued)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, job: Callable[[], None], block: bool = True) -> concurrent.futures.Future:
+        """
+        Queue up a job for the save thread.
+
+        :raises queue.Full: if block is False and the queue is full
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="AutoSavingDict writer", daemon=True)
+                self._thread.start()
+        future = concurrent.futures.Future()
+        self._queue.put((job, future), block=block)
+        return future
+
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while True:
+            job, future = self._queue.get()
+            try:
+                future.set_result(job())
+            except BaseException as e:
+                logging.exception("Failed to save data.")
+                future.set_exception(e)
+
+
+_save_worker = _SaveWorker()
+
+
+class _Unloaded:
+    """
+    Stands in for a shard of a ShardedAutoSavingDict that hasn't been read from its file yet.
+    """
+
+    def __repr__(self):
+        return "<unloaded shard>"
+
+
+_UNLOADED = _Unloaded()
+
+
+class ShardedAutoSavingDict(AutoSavingDict):
+    """
+    An AutoSavingDict that keeps each top-level key in its own file inside of a directory. Shards are only read once
+    they are accessed, and a save only rewrites the shards that changed since the last one.
+    """
+
+    def __init__(self, directory: str, write_behind_interval: Optional[float] = None, threaded_writes: bool = False,
+                 migrate_from: Optional[str] = None, codec: str = "json", memory_map: bool = False):
+        """
+        :param directory: the directory to keep the shard files in
+        :param write_behind_interval: see AutoSavingDict
+        :param threaded_writes: see AutoSavingDict
+        :param migrate_from: a data file to split into shards if the directory doesn't exist yet
+        :param codec: see AutoSavingDict
+        :param memory_map: see AutoSavingDict
+        """
+        self.directory = directory
+        self.migrate_from = migrate_from
+        self._dirty_shards = set()
+        super().__init__(directory, write_behind_interval, threaded_writes=threaded_writes, lazy=True, codec=codec,
+                         memory_map=memory_map)
+
+    def __getitem__(self, k):
+        if dict.__getitem__(self, k) is _UNLOADED:
+            dict.__setitem__(self, k, _wrap_loaded(self._on_change, self._file.read_shard(k), self, k))
+        return super().__getitem__(k)
+
+    def clear(self) -> None:
+        self._dirty_shards.update(dict.keys(self))
+        super().clear()
+
+    def shard_loaded(self, k) -> bool:
+        return dict.__getitem__(self, k) is not _UNLOADED
+
+    def _make_writer(self) -> "_ShardFileWriter":
+        return _ShardFileWriter(self.directory, self.codec, self.memory_map)
+
+    def _get_data(self) -> dict:
+        if not self._file.exists():
+            self._file.create()
+            if self.migrate_from is not None and os.path.exists(self.migrate_from):
+                data_raw, _ = datacodecs.read_file(self.migrate_from, self.memory_map, self.codec)
+                self._file.write_shards(data_raw, [])
+                os.replace(self.migrate_from, self.migrate_from + ".migrated")
+        return {k: _UNLOADED for k in self._file.list_shards()}
+
+    def _wrap_all(self) -> None:
+        if self._lazy:
+            for k, v in list(dict.items(self)):
+                if v is _UNLOADED:
+                    dict.__setitem__(self, k, self._file.read_shard(k))
+        super()._wrap_all()
+
+    def _record_change(self, container, op: str, key, value) -> None:
+        if container is self:
+            if key is not None:
+                self._dirty_shards.add(key)
+            return
+        while container.parent is not self:
+            if container.parent is None:
+                return
+            container = container.parent
+        if dict.get(self, container.key) is container:
+            self._dirty_shards.add(container.key)
+
+    def _prepare_write(self, copy: bool = False) -> Callable[[], None]:
+        changed, deleted = self._take_dirty_shards()
+        return functools.partial(self._file.write_shards, changed, deleted)
+
+    def _write_failed(self, job: functools.partial) -> None:
+        changed, deleted = job.args[:2]
+        self._dirty_shards.update(changed)
+        self._dirty_shards.update(deleted)
+        super()._write_failed(job)
+
+    def _take_dirty_shards(self) -> Tuple[dict, list]:
+        """
+        :return: a copy of each shard that changed since the last save, and the shards that were deleted
+        """
+        changed = {}
+        deleted = []
+        for k in self._dirty_shards:
+            if not dict.__contains__(self, k):
+                deleted.append(k)
+                continue
+            v = dict.__getitem__(self, k)
+            if v is not _UNLOADED:
+                changed[k] = _snapshot(v)
+        self._dirty_shards = set()
+        return changed, deleted
+
+
+class _ShardFileWriter:
+    """
+    Does the file reading and writing for a ShardedAutoSavingDict.
+    """
+
+    extensions = [datacodecs.JsonCodec.extension, datacodecs.MsgpackCodec.extension]
+
+    def __init__(self, directory: str, codec, memory_map: bool = False):
+        self.directory = directory
+        self.codec = codec
+        self.memory_map = memory_map
+        self.bytes_written = 0
+
+    def exists(self) -> bool:
+        return os.path.isdir(self.directory)
+
+    def create(self) -> None:
+        os.makedirs(self.directory)
+
+    def shard_location(self, key, extension: Optional[str] = None) -> str:
+        return os.path.join(self.directory,
+                            urllib.parse.quote(_json_key(key), safe="") + (extension or self.codec.extension))
+
+    def list_shards(self) -> List[str]:
+        keys = []
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            if extension in self.extensions:
+                keys.append(urllib.parse.unquote(stem))
+        return keys
+
+    def read_shard(self, key):
+        # A shard can hold anything, so its format comes from its extension rather than its contents
+        for extension in [self.codec.extension] + self.extensions:
+            try:
+                data, _ = datacodecs.read_file(self.shard_location(key, extension), self.memory_map,
+                                               datacodecs.codec_for_extension(extension, self.codec), detect=False)
+                return data
+            except FileNotFoundError:
+                pass
+        raise KeyError(key)
+
+    def write_shards(self, changed: dict, deleted: List) -> None:
+        for k, v in changed.items():
+            raw = self.codec.dumps(v)
+            _atomic_write(self.shard_location(k), raw)
+            self.bytes_written += len(raw)
+        for k in deleted:
+            for extension in self.extensions:
+                try:
+                    os.remove(self.shard_location(k, extension))
+                except FileNotFoundError:
+                    pass
+        # Clean up shards that were saved with a different codec
+        for k in changed:
+            for extension in self.extensions:
+                if extension != self.codec.extension and os.path.exists(self.shard_location(k, extension)):
+                    os.remove(self.shard_location(k, extension))
+
+
+class SqliteAutoSavingDict(ShardedAutoSavingDict):
+    """
+    A ShardedAutoSavingDict that keeps each top-level key in its own row of a SQLite database instead of its own file.
+    Top-level keys that hold a map from guild id to that guild's data can be given their own row for each guild
+    instead, so a change to one guild only rewrites that guild's row. Saves write every changed row in a single
+    transaction.
+
+    Only writes are per guild. The first time a per guild key is used, every one of its guilds' rows is read, the same
+    as any other shard.
+    """
+
+    def __init__(self, database_location: str, write_behind_interval: Optional[float] = None,
+                 threaded_writes: bool = False, migrate_from: Optional[str] = None, codec: str = "json",
+                 per_guild_keys: Collection[str] = ()):
+        """
+        :param database_location: the SQLite database file to keep the data in
+        :param write_behind_interval: see AutoSavingDict
+        :param threaded_writes: see AutoSavingDict
+        :param migrate_from: a data file to copy into the database if the database doesn't exist yet
+        :param codec: see AutoSavingDict
+        :param per_guild_keys: the top-level keys holding a dict keyed by guild id, to keep a row for each guild of
+        """
+        self.per_guild_keys = frozenset(per_guild_keys)
+        # (top-level key, guild id) of the per guild rows that changed since the last save
+        self._dirty_rows = set()
+        super().__init__(database_location, write_behind_interval, threaded_writes, migrate_from, codec)
+
+    def _make_writer(self) -> "_SqliteShardWriter":
+        return _SqliteShardWriter(self.directory, self.codec, self.per_guild_keys)
+
+    def _record_change(self, container, op: str, key, value) -> None:
+        if container is not self:
+            # Find the guild's data under a per guild key, if that's what changed
+            guild_data = None
+            while container.parent is not self:
+                if container.parent is None:
+                    return
+                guild_data, container = container, container.parent
+            if container.key in self.per_guild_keys and dict.get(self, container.key) is container:
+                if guild_data is None and op in ("set", "del"):
+                    self._dirty_rows.add((container.key, key))
+                    return
+                if guild_data is not None and dict.get(container, guild_data.key) is guild_data:
+                    self._dirty_rows.add((container.key, guild_data.key))
+                    return
+        super()._record_change(container, op, key, value)
+
+    def _prepare_write(self, copy: bool = False) -> Callable[[], None]:
+        changed_rows = {}
+        deleted_rows = []
+        for k, guild in self._dirty_rows:
+            if k in self._dirty_shards:
+                # The whole key is being rewritten anyway
+                continue
+            guilds = dict.get(self, k)
+            if guilds is _UNLOADED:
+                # Put back unloaded by a failed batch, so it's the same as what was saved
+                continue
+            if not isinstance(guilds, dict):
+                self._dirty_shards.add(k)
+            elif dict.__contains__(guilds, guild):
+                changed_rows[(k, guild)] = _snapshot(dict.__getitem__(guilds, guild))
+            else:
+                deleted_rows.append((k, guild))
+        self._dirty_rows = set()
+        changed, deleted = self._take_dirty_shards()
+        return functools.partial(self._file.write_shards, changed, deleted, changed_rows, deleted_rows)
+
+    def _write_failed(self, job: functools.partial) -> None:
+        changed_rows, deleted_rows = job.args[2:]
+        self._dirty_rows.update(changed_rows)
+        self._dirty_rows.update(deleted_rows)
+        super()._write_failed(job)
+
+
+class _SqliteShardWriter:
+    """
+    Does the database reading and writing for a SqliteAutoSavingDict.
+    """
+
+    def __init__(self, database_location: str, codec, per_guild_keys: Collection[str] = ()):
+        self.database_location = database_location
+        self.codec = codec
+        self.per_guild_keys = per_guild_keys
+        self.bytes_written = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        # Rows are read from the event loop and written from the save thread
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.database_location)
+
+    def create(self) -> None:
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.database_location, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            # Each top-level key has a row with an empty guild id. A per guild key's row holds an empty dict, and each
+            # of its guilds gets a row of its own.
+            self._connection.execute("CREATE TABLE IF NOT EXISTS data (key TEXT NOT NULL, guild TEXT NOT NULL, "
+                                     "value TEXT NOT NULL, PRIMARY KEY (key, guild)) WITHOUT ROWID")
+        return self._connection
+
+    def list_shards(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connect().execute("SELECT key FROM data WHERE guild = ''")]
+
+    def read_shard(self, key):
+        # A per guild key comes back whole, with every guild's row
+        with self._lock:
+            rows = self._connect().execute("SELECT guild, value FROM data WHERE key = ?", (_json_key(key),)).fetchall()
+        values = {guild: self._loads(raw) for guild, raw in rows}
+        if "" not in values:
+            raise KeyError(key)
+        shard = values.pop("")
+        if values:
+            shard.update(values)
+        return shard
+
+    def _loads(self, raw):
+        # Json is stored as text and msgpack as a blob, since a row can hold a scalar that looks like either
+        if isinstance(raw, str):
+            return datacodecs.codec_for_extension(datacodecs.JsonCodec.extension, self.codec).loads(raw.encode())
+        return datacodecs.codec_for_extension(datacodecs.MsgpackCodec.extension, self.codec).loads(raw)
+
+    def _dumps(self, value):
+        raw = self.codec.dumps(value)
+        return raw.decode() if isinstance(self.codec, datacodecs.JsonCodec) else raw
+
+    def write_shards(self, changed: dict, deleted: List, changed_rows: Optional[dict] = None,
+                     deleted_rows: Optional[List[tuple]] = None) -> None:
+        """
+        :param changed: the top-level keys to rewrite every row of
+        :param deleted: the top-level keys to delete every row of
+        :param changed_rows: (top-level key, guild id) -> the guild's data, for per guild rows to rewrite
+        :param deleted_rows: the (top-level key, guild id) of per guild rows to delete
+        """
+        rows = []
+        for k, v in changed.items():
+            if k in self.per_guild_keys and isinstance(v, dict):
+                rows.append((_json_key(k), "", self._dumps({})))
+                rows.extend((_json_key(k), _json_key(guild), self._dumps(data)) for guild, data in v.items())
+            else:
+                rows.append((_json_key(k), "", self._dumps(v)))
+        rows.extend((_json_key(k), _json_key(guild), self._dumps(data))
+                    for (k, guild), data in (changed_rows or {}).items())
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("DELETE FROM data WHERE key = ?",
+                                       [(_json_key(k),) for k in list(changed) + list(deleted)])
+                connection.executemany("DELETE FROM data WHERE key = ? AND guild = ?",
+                                       [(_json_key(k), _json_key(guild)) for k, guild in deleted_rows or []])
+                connection.executemany("INSERT OR REPLACE INTO data (key, guild, value) VALUES (?, ?, ?)", rows)
+        self.bytes_written += sum(len(key) + len(guild) + len(value) for key, guild, value in rows)
@@ -0,0 +1,132 @@
+"""
+Compares validating and wrapping values for an AutoSavingDict in one pass against a copy of the old approach, which
+validated with json.dumps first and then wrapped, and did both again for every nested assignment.
+
+Usage: python -m benchmarks.autosavedict_convert
+"""
+import json
+import timeit
+
+from autosavedict import _convert, CallbackOnUpdateDict, NotSavableError
+
+
+def _noop(*args):
+    pass
+
+
+# A copy of the converters from before values were validated and wrapped in one pass
+
+def _old_is_jsonable(item):
+    try:
+        json.dumps(item)
+        return True
+    except TypeError or OverflowError:
+        return False
+
+
+class _OldCallbackOnUpdateDict(dict):
+    def __init__(self, callback, parent=None, key=None):
+        super().__init__()
+        self.callback = callback
+        self.parent = parent
+        self.key = key
+
+    def __setitem__(self, k, v):
+        if not _old_is_jsonable(v):
+            raise NotSavableError(f"Object {v} cannot be saved in a file, and will not be added.")
+        v = _old_convert(self.callback, v, self, k)
+        super().__setitem__(k, v)
+        self.callback(self, "set", k, v)
+
+
+class _OldCallbackOnUpdateList(list):
+    def __init__(self, callback, parent=None, key=None):
+        super().__init__()
+        self.callback = callback
+        self.parent = parent
+        self.key = key
+
+
+def _old_recurse_convert_list(callback, raw: list, parent=None, key=None) -> list:
+    converted = _OldCallbackOnUpdateList(callback, parent=parent, key=key)
+    for v in raw:
+        if isinstance(v, list):
+            v = _old_recurse_convert_list(callback, v, converted)
+        elif isinstance(v, dict):
+            v = _old_recurse_convert_dict(callback, v, converted)
+        list.append(converted, v)
+    return converted
+
+
+def _old_recurse_convert_dict(callback, raw: dict, parent=None, key=None) -> dict:
+    converted = _OldCallbackOnUpdateDict(callback, parent=parent, key=key)
+    for k, v in raw.items():
+        if isinstance(v, list):
+            v = _old_recurse_convert_list(callback, v, converted, k)
+        elif isinstance(v, dict):
+            v = _old_recurse_convert_dict(callback, v, converted, k)
+        dict.__setitem__(converted, k, v)
+    return converted
+
+
+def _old_convert(callback, v, parent, key=None):
+    if isinstance(v, dict):
+        return _old_recurse_convert_dict(callback, v, parent, key)
+    if isinstance(v, list):
+        return _old_recurse_convert_list(callback, v, parent, key)
+    return v
+
+
+def deep_value(depth: int):
+    value = {"leaf": list(range(10))}
+    for i in range(depth):
+        value = {"level": i, "child": value, "siblings": [i, str(i), None]}
+    return value
+
+
+def wide_value(width: int):
+    return {str(i): {"keyword": f"word {i}", "reaction": "hi", "method": "anywhere", "channel": False}
+            for i in range(width)}
+
+
+def assign_old(value):
+    _OldCallbackOnUpdateDict(_noop)["value"] = value
+
+
+def assign_new(value):
+    CallbackOnUpdateDict(_noop)["value"] = value
+
+
+def build(container, value: dict):
+    """
+    Copy value into container one key at a time, the way cogs fill in their data.
+    """
+    for k, v in value.items():
+        if isinstance(v, dict):
+            container[k] = {}
+            build(container[k], v)
+        else:
+            container[k] = v
+
+
+def main():
+    cases = {
+        "deep (depth 200)": deep_value(200),
+        "wide (5,000 keys)": wide_value(5000),
+    }
+    number = 10
+    for name, value in cases.items():
+        for how, old_run, new_run in (
+                ("assigned at once", lambda: assign_old(value), lambda: assign_new(value)),
+                ("built key by key", lambda: build(_OldCallbackOnUpdateDict(_noop), value),
+                 lambda: build(CallbackOnUpdateDict(_noop), value))):
+            # Alternate between the two so that a noisy moment doesn't only slow one of them down
+            old = new = float("inf")
+            for _ in range(15):
+                old = min(old, timeit.timeit(old_run, number=number) / number)
+                new = min(new, timeit.timeit(new_run, number=number) / number)
+            print(f"{name}, {how}: old {old * 1000:.3f} ms, one-pass {new * 1000:.3f} ms, speedup {old / new:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares checking a message against every custom listener's regex one at a time with the single-pass ListenerMatcher,
+for guilds with 10, 100 and 1,000 listeners.
+
+Usage: python -m benchmarks.customlistener_matching
+"""
+import random
+import timeit
+
+from customlistener.matcher import ListenerMatcher, compile_keyword
+
+WORDS = ["hello", "there", "general", "kenobi", "cat", "dog", "pizza", "bot", "good", "morning", "night", "lol",
+         "what", "why", "when", "game", "play", "music", "song", "movie"]
+MESSAGE = ("good morning everyone, did anybody see the game last night? the music was way too loud and "
+           "the pizza was cold, but the movie after was pretty fun lol")
+
+
+def make_listeners(count: int) -> dict:
+    random.seed(count)
+    listeners = {}
+    for i in range(count):
+        keyword = " ".join(random.sample(WORDS, random.randint(1, 2))) + (str(i) if i % 3 else "")
+        if i % 10 == 0:
+            # Some listeners use regex syntax, and are left to their own pattern
+            keyword = f"(good|bad) {random.choice(WORDS)}"
+        listeners[f"listener{i}"] = {"keyword": keyword, "reaction": "hi", "channel": False,
+                                     "method": random.choice(["anywhere", "anywhere", "start", "end"])}
+    return listeners
+
+
+def main():
+    for count in (10, 100, 1000):
+        listeners = make_listeners(count)
+        patterns = [(name, compile_keyword(info["method"], info["keyword"])) for name, info in listeners.items()]
+        matcher = ListenerMatcher(listeners)
+
+        def one_at_a_time():
+            return [name for name, pattern in patterns if pattern.search(MESSAGE)]
+
+        assert one_at_a_time() == matcher.matches(MESSAGE).names
+        runs = 2000 if count < 1000 else 200
+        regex = timeit.timeit(one_at_a_time, number=runs) / runs
+        combined = timeit.timeit(lambda: matcher.matches(MESSAGE), number=runs) / runs
+        build = timeit.timeit(lambda: ListenerMatcher(listeners), number=10) / 10
+        print(f"{count:>5} listeners: per-listener regexes {regex * 1e6:9.1f} us, matcher {combined * 1e6:9.1f} us "
+              f"per message (building the matcher takes {build * 1000:.2f} ms)")
+
+
+if __name__ == '__main__':
+    main()
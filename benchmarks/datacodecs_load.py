@@ -0,0 +1,44 @@
+"""
+Compares how long each datacodecs codec takes to load a CogWithData's datafile at startup, and how large the file is.
+
+Usage: python -m benchmarks.datacodecs_load
+"""
+import os
+import tempfile
+import time
+
+import datacodecs
+from autosavedict import AutoSavingDict
+from benchmarks.storage_engines import make_data
+
+RUNS = 5
+
+
+def bench(name: str, location: str, codec: str, memory_map: bool):
+    best = float("inf")
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        # lazy, so the time is spent decoding the file rather than wrapping what was loaded
+        AutoSavingDict(location, lazy=True, codec=codec, memory_map=memory_map)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>12}: load {best * 1000:9.2f} ms, {os.path.getsize(location):10d} bytes")
+
+
+def main():
+    data = make_data()
+    with tempfile.TemporaryDirectory() as directory:
+        for codec in datacodecs.codec_options:
+            try:
+                codec_class = datacodecs.get_codec(codec)
+            except ImportError:
+                print(f"{codec:>12}: not installed")
+                continue
+            location = os.path.join(directory, f"{codec}_data{codec_class.extension}")
+            with open(location, 'wb') as file:
+                file.write(codec_class.dumps(data))
+            bench(codec, location, codec, False)
+            bench(codec + " mmap", location, codec, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares the per-pixel loop Fry.bulge used to run with the whole-array fry.effects.bulge_pixels, on a 1000x1000 image
+at several radii, and checks that they produce the same pixels.
+
+Usage: python -m benchmarks.fry_bulge
+"""
+import math
+import time
+
+import numpy as np
+
+from fry.effects import bulge_pixels
+
+
+def looped_bulge(img_data, f, r, a, h, ior):
+    """
+    The old Fry.bulge, without the awaits.
+    """
+    height, width = img_data.shape[:2]
+    x_min = max(int(f[0] - r), 0)
+    x_max = min(int(f[0] + r), width)
+    y_min = max(int(f[1] - r), 0)
+    y_max = min(int(f[1] + r), height)
+
+    bulged = np.copy(img_data)
+    for y in range(y_min, y_max):
+        for x in range(x_min, x_max):
+            ray = np.array([x, y])
+            s = np.sqrt(np.sum(np.square(ray - f)))
+            if 0 < s < r:
+                m = -s / (a * math.sqrt(r ** 2 - s ** 2))
+                theta = np.pi / 2 + np.arctan(1 / m)
+                phi = np.abs(np.arctan(1 / m) - np.arcsin(np.sin(theta) / ior))
+                k = (h + (math.sqrt(r ** 2 - s ** 2) / a)) / np.sin(phi)
+                direction = f - ray
+                intersect = ray + direction / np.sqrt(np.sum(np.square(direction))) * k
+                if 0 < intersect[0] < width - 1 and 0 < intersect[1] < height - 1:
+                    bulged[y][x] = img_data[int(intersect[1])][int(intersect[0])]
+                else:
+                    bulged[y][x] = [0, 0, 0]
+            else:
+                bulged[y][x] = img_data[y][x]
+    return bulged
+
+
+def main():
+    rng = np.random.default_rng(0)
+    img_data = rng.integers(0, 256, (1000, 1000, 3), dtype=np.uint8)
+    f = np.array([480, 530])
+    for r in (50, 100, 200, 400):
+        start = time.perf_counter()
+        looped = looped_bulge(img_data, f, r, 3, 5, 1.8)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        vectorized = bulge_pixels(img_data, f, r, 3, 5, 1.8)
+        vectorized_time = time.perf_counter() - start
+        assert np.array_equal(looped, vectorized)
+        print(f"radius {r:>4}: per-pixel loop {loop_time * 1000:10.1f} ms, whole-array {vectorized_time * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
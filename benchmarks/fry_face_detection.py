@@ -0,0 +1,60 @@
+"""
+Times finding faces the way Fry.find_eyes used to (two full size passes), one full size pass, one pass on a downscaled
+copy, and a cached repeat, on 1, 4 and 12 megapixel images.
+
+Pass the path of a photo with faces in it to time that instead of a generated image, and to see whether each mode
+finds the same faces.
+
+Usage: python -m benchmarks.fry_face_detection [photo]
+"""
+import sys
+import time
+
+import dlib
+import numpy as np
+from PIL import Image
+
+from fry import pipeline
+
+
+def make_image(megapixels: int, photo: Image.Image = None) -> np.ndarray:
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    if photo is not None:
+        return np.array(photo.convert("L").resize((width, height), Image.BILINEAR))
+    rng = np.random.default_rng(megapixels)
+    gradient = np.linspace(0, 200, width, dtype=np.float32)[None, :] + np.linspace(0, 55, height)[:, None]
+    return (gradient + rng.normal(0, 10, (height, width))).clip(0, 255).astype(np.uint8)
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def main():
+    photo = Image.open(sys.argv[1]) if len(sys.argv) > 1 else None
+    detector = dlib.get_frontal_face_detector()
+    for megapixels in (1, 4, 12):
+        gray = make_image(megapixels, photo)
+        pipeline._detections.clear()
+
+        def old():
+            detector(gray, 1)
+            return [(r.left(), r.top(), r.right(), r.bottom()) for r in detector(gray, 1)]
+
+        old_time, old_faces = timed(old)
+        full_time, _ = timed(lambda: pipeline.face_rects(gray, detector, None))
+        small_time, small_faces = timed(lambda: pipeline.face_rects(gray, detector))
+        pipeline.cached_face_rects(gray, detector)
+        cached_time, _ = timed(lambda: pipeline.cached_face_rects(gray, detector))
+        print(f"{megapixels:>2} MP ({gray.shape[1]}x{gray.shape[0]}): two full passes {old_time * 1000:8.0f} ms, "
+              f"one full pass {full_time * 1000:8.0f} ms, downscaled {small_time * 1000:6.0f} ms, "
+              f"cached {cached_time * 1000:5.1f} ms")
+        if photo is not None:
+            print(f"    faces: full size {old_faces}, downscaled {small_faces}")
+
+
+if __name__ == '__main__':
+    main()
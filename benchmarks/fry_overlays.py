@@ -0,0 +1,50 @@
+"""
+Compares adding B emojis the old way, reopening b.png and resizing a fresh copy for every placement, with the cached
+overlays in fry.pipeline, on a screenshot-like image with hundreds of characters. Checks that both give the same pixels.
+
+Usage: python -m benchmarks.fry_overlays
+"""
+import time
+
+import numpy as np
+from PIL import Image
+
+from fry import pipeline
+
+
+def reopened_b_emojis(img, coords):
+    tmp = img.copy()
+    b = Image.open(pipeline._directory + 'b.png')
+    for coord in coords:
+        if np.random.random(1)[0] < 0.1:
+            resized = b.copy()
+            resized.thumbnail((coord[2], coord[3]), Image.LANCZOS)
+            tmp.paste(resized, (int(coord[0]), int(coord[1])), resized)
+    return tmp
+
+
+def main():
+    img = Image.new("RGB", (1920, 1080), "white")
+    # Characters in a few font sizes, laid out in lines of text
+    coords = [(x, y, size * 3 // 5, size) for size in (12, 14, 16) for y in range(0, 1080 - size, size * 3)
+              for x in range(0, 1920 - size, size)]
+    for count in (1000, len(coords)):
+        chosen = coords[:count]
+        np.random.seed(0)
+        start = time.perf_counter()
+        old = reopened_b_emojis(img, chosen)
+        old_time = time.perf_counter() - start
+
+        pipeline.resized_asset.cache_clear()
+        np.random.seed(0)
+        start = time.perf_counter()
+        cached = pipeline.add_b_emojis(img, chosen)
+        cached_time = time.perf_counter() - start
+
+        assert np.array_equal(np.array(old), np.array(cached))
+        print(f"{len(chosen):>6} characters: reopened and resized {old_time * 1000:7.1f} ms, "
+              f"cached {cached_time * 1000:6.1f} ms ({pipeline.resized_asset.cache_info().hits} cache hits)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Compares the old Fry noise and contrast steps, two Image.point calls with Python callbacks, with the fused lookup table
+from fry.effects.apply_curves, and checks that they produce the same pixels from the same random state.
+
+Usage: python -m benchmarks.fry_tone
+"""
+import time
+
+import numpy as np
+from PIL import Image
+
+from fry.effects import apply_curves, contrast_curve, noise_curve
+
+
+def two_passes(img, factor, level):
+    def noise(c):
+        return c * (1 + np.random.random(1)[0] * factor - factor / 2)
+
+    contrast_factor = (259 * (level + 255)) / (255 * (259 - level))
+
+    def contrast(c):
+        return 128 + contrast_factor * (c - 128)
+
+    return img.point(noise).point(contrast)
+
+
+def main():
+    for megapixels in (1, 4, 12):
+        width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+        rng = np.random.default_rng(megapixels)
+        img = Image.fromarray(rng.integers(0, 256, (width * 3 // 4, width, 3), dtype=np.uint8))
+
+        np.random.seed(megapixels)
+        start = time.perf_counter()
+        old = two_passes(img, 0.2, 200)
+        old_time = time.perf_counter() - start
+
+        np.random.seed(megapixels)
+        start = time.perf_counter()
+        fused = apply_curves(img, noise_curve(0.2), contrast_curve(200))
+        fused_time = time.perf_counter() - start
+
+        assert np.array_equal(np.array(old), np.array(fused))
+        print(f"{megapixels:>2} MP: two point() passes {old_time * 1000:7.1f} ms, fused table {fused_time * 1000:6.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
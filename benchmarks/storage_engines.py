@@ -0,0 +1,97 @@
+"""
+Compares the json, sharded and sqlite storage engines for a CogWithData holding 10,000 guilds of custom listeners, and
+for one like Rude's, which keeps a few top-level maps from guild id to users. Those are stored with and without a row
+for each guild.
+
+Usage: python -m benchmarks.storage_engines
+"""
+import json
+import os
+import tempfile
+import time
+
+from autosavedict import AutoSavingDict, ShardedAutoSavingDict, SqliteAutoSavingDict
+
+GUILDS = 10_000
+LISTENERS_PER_GUILD = 5
+CHANGES = 100
+
+
+def make_data() -> dict:
+    return {
+        str(guild): {
+            f"listener{i}": {"keyword": f"word {i}", "reaction": "hello!", "method": "anywhere", "channel": False}
+            for i in range(LISTENERS_PER_GUILD)
+        }
+        for guild in range(GUILDS)
+    }
+
+
+def make_per_guild_data() -> dict:
+    return {attack: {str(guild): list(range(5)) for guild in range(GUILDS)} for attack in ("mimic", "silence", "mock")}
+
+
+def bench(name: str, make_store, change_one):
+    start = time.perf_counter()
+    store = make_store()
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(CHANGES):
+        change_one(store, i)
+    change = (time.perf_counter() - start) / CHANGES
+
+    print(f"{name:>16}: load {load * 1000:9.2f} ms, change one guild and save {change * 1000:7.3f} ms, "
+          f"{store.save_stats()['bytes_written'] / CHANGES:10.0f} bytes per save")
+
+
+def change_listener(store, i: int) -> None:
+    store[str(i * 97 % GUILDS)]["listener0"]["reaction"] = f"changed {i}"
+
+
+def change_user_list(store, i: int) -> None:
+    store["mimic"][str(i * 97 % GUILDS)].append(i)
+
+
+def main():
+    data = make_data()
+    print("Custom listeners, one top-level key per guild")
+    with tempfile.TemporaryDirectory() as directory:
+        engines = {
+            "json": lambda: AutoSavingDict(os.path.join(directory, "json_data.json")),
+            "sharded": lambda: ShardedAutoSavingDict(os.path.join(directory, "sharded_data"),
+                                                     migrate_from=os.path.join(directory, "sharded_data.json")),
+            "sqlite": lambda: SqliteAutoSavingDict(os.path.join(directory, "sqlite_data.sqlite3"),
+                                                   migrate_from=os.path.join(directory, "sqlite_data.json")),
+        }
+        for name in engines:
+            with open(os.path.join(directory, f"{name}_data.json"), 'w') as file:
+                json.dump(data, file)
+        # Migrate first, so only loading an existing store gets timed
+        for make_store in engines.values():
+            make_store()
+        for name, make_store in engines.items():
+            bench(name, make_store, change_listener)
+
+    data = make_per_guild_data()
+    print("Guild maps under a few top-level keys")
+    with tempfile.TemporaryDirectory() as directory:
+        engines = {
+            "json": lambda: AutoSavingDict(os.path.join(directory, "json_data.json")),
+            "sqlite": lambda: SqliteAutoSavingDict(os.path.join(directory, "sqlite_data.sqlite3"),
+                                                   migrate_from=os.path.join(directory, "sqlite_data.json")),
+            "sqlite per guild": lambda: SqliteAutoSavingDict(
+                os.path.join(directory, "guild_data.sqlite3"), migrate_from=os.path.join(directory, "guild_data.json"),
+                per_guild_keys=data.keys()),
+        }
+        for file_name in ("json_data.json", "sqlite_data.json", "guild_data.json"):
+            with open(os.path.join(directory, file_name), 'w') as file:
+                json.dump(data, file)
+        for make_store in engines.values():
+            make_store()
+        for name, make_store in engines.items():
+            bench(name, make_store, change_user_list)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,12 @@ import itertools
 import logging
 import os
 import sys
+import time
 from datetime import datetime
 from importlib import import_module
 from importlib.machinery import ModuleSpec
 from random import choice
-from typing import List
+from typing import List, Optional
 
 import click
 import nextcord
@@ -16,6 +17,10 @@ from dotenv import load_dotenv
 
 from autosavedict import AutoSavingDict
 from checks import NoPermissionError
+from lagmonitor import LoopLagMonitor, running_handler
+from latency import LatencyRegistry
+from messagepipeline import MessagePipeline
+from metrics import MetricsServer
 
 
 TOKEN_KEY = "BOT_TOKEN"
@@ -239,6 +244,16 @@ class StatiCat(commands.Bot):
         self.should_restart = False
         self.send_startup_message_to_owner = False
         self.global_data = AutoSavingDict("global_data.json")
+        # Not called latency, since nextcord uses that for the websocket heartbeat
+        self.handler_latency = LatencyRegistry()
+        # How often to log the slowest handlers, in seconds, or 0 to not
+        self.latency_log_interval = 0
+        # The original listener functions, keyed with their event name, mapped to their timed wrappers
+        self._timed_listeners = {}
+        self.message_pipeline = MessagePipeline(self.handler_latency)
+        self.lag_monitor = LoopLagMonitor()
+        # Set from the command line to serve metrics, which is off by default
+        self.metrics_server: Optional[MetricsServer] = None
 
         super().__init__(command_prefix=self.get_prefixes(), **options)
 
@@ -307,6 +322,14 @@ class StatiCat(commands.Bot):
 
     async def on_ready(self):
         logging.info(f"Logged in as {self.user}")
+        self.lag_monitor.start()
+        if self.latency_log_interval > 0:
+            self.handler_latency.start_logging(self.latency_log_interval)
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError:
+                logging.exception("Failed to start the metrics server.")
 
         await self.load_cogs()
         self.help_command = EmbeddingHelpCommand(self.get_color_palette(),
@@ -323,6 +346,29 @@ class StatiCat(commands.Bot):
 
         await self.sync_all_application_commands()
 
+    async def on_message(self, message: nextcord.Message):
+        if self.user is not None and message.author.id == self.user.id:
+            await self.process_commands(message)
+            return
+        # The stages run alongside the command, like cogs' on_message listeners used to, so a slow command doesn't hold
+        # up replies or a silenced message being deleted
+        await asyncio.gather(self.process_commands(message), self.message_pipeline.dispatch(message))
+
+    def add_listener(self, func, name: str = nextcord.utils.MISSING):
+        event_name = func.__name__ if name is nextcord.utils.MISSING else name
+        if not asyncio.iscoroutinefunction(func):
+            # Let nextcord complain about it
+            return super().add_listener(func, event_name)
+        owner = getattr(func, "__self__", None)
+        cog_name = owner.qualified_name if isinstance(owner, commands.Cog) else "Bot"
+        timed = self.handler_latency.wrap(cog_name, event_name, func)
+        self._timed_listeners[(func, event_name)] = timed
+        super().add_listener(timed, event_name)
+
+    def remove_listener(self, func, name: str = nextcord.utils.MISSING):
+        event_name = func.__name__ if name is nextcord.utils.MISSING else name
+        super().remove_listener(self._timed_listeners.pop((func, event_name), func), event_name)
+
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
         if isinstance(error, commands.CheckFailure):
             logging.error("Caught a command checks error.", exc_info=(type(error), error, error.__traceback__))
@@ -353,7 +399,29 @@ class StatiCat(commands.Bot):
             if self.global_data["deny odds"] != 0 and choice(range(self.global_data["deny odds"])) == 0:
                 await ctx.send(choice(self.global_data["deny choices"]))
                 return
-        return await super().invoke(ctx)
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        cog_name = ctx.cog.qualified_name if ctx.cog is not None else "Bot"
+        start = time.perf_counter()
+        try:
+            with running_handler(f"{cog_name}.{ctx.command.qualified_name}"):
+                return await super().invoke(ctx)
+        finally:
+            self.handler_latency.record(cog_name, ctx.command.qualified_name, time.perf_counter() - start,
+                                        bool(ctx.command_failed))
+
+    async def close(self):
+        self.lag_monitor.stop()
+        self.handler_latency.stop_logging()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        # Make sure nothing waiting on a write-behind timer gets lost
+        self.global_data.flush()
+        for cog in self.cogs.values():
+            data = getattr(cog, "data", None)
+            if isinstance(data, AutoSavingDict):
+                data.flush()
+        await super().close()
 
     async def message_owner(self, message: str):
         owner: nextcord.User = await self.fetch_user(self.owner_id)
@@ -366,7 +434,12 @@ class StatiCat(commands.Bot):
               type=click.Choice(list(logging._nameToLevel.keys()), case_sensitive=False),
               default="INFO")
 @click.option("-m", "--message-owner", is_flag=True)
-def main(log_level, message_owner):
+@click.option("--latency-log-interval", type=float, default=0,
+              help="Log the slowest commands and listeners every this many seconds. Off by default.")
+@click.option("--metrics-port", type=int, default=None,
+              help="Serve Prometheus metrics on this port. Off by default.")
+@click.option("--metrics-host", default="127.0.0.1", help="The address to serve metrics on.")
+def main(log_level, message_owner, latency_log_interval, metrics_port, metrics_host):
     global bot
 
     clean_files()
@@ -388,6 +461,9 @@ def main(log_level, message_owner):
 
     if message_owner:
         bot.send_startup_message_to_owner = True
+    bot.latency_log_interval = latency_log_interval
+    if metrics_port is not None:
+        bot.metrics_server = MetricsServer(bot, metrics_host, metrics_port)
 
     logging.info(sys.argv)
 
@@ -1,10 +1,12 @@
 import json
 import inspect
-from typing import Optional
+import os
+from typing import Collection, Optional
 
 import nextcord.ext.commands as commands
 
-from autosavedict import AutoSavingDict
+import datacodecs
+from autosavedict import AutoSavingDict, ShardedAutoSavingDict, SqliteAutoSavingDict
 
 
 class CogWithData(commands.Cog):
@@ -12,16 +14,62 @@ class CogWithData(commands.Cog):
     A Cog that has data management with json files.
     """
 
-    def __init__(self, data_file_name: Optional[str] = None):
+    storage_options = ["json", "journal", "sharded", "sqlite"]
+
+    def __init__(self, data_file_name: Optional[str] = None, write_behind_interval: Optional[float] = None,
+                 storage: str = "json", threaded_writes: bool = False, lazy: bool = False, codec: str = "json",
+                 memory_map: bool = False, per_guild_keys: Collection[str] = ()):
         """
         :param data_file_name: the optional name to give to the datafile
+        :param write_behind_interval: if set, changes are saved at most once every write_behind_interval seconds
+        :param storage: "json" rewrites the whole datafile on save, "journal" appends each change to a journal that is
+        periodically compacted into the datafile, and "sharded" keeps each top-level key (usually a guild id) in its own
+        file in a directory named after the datafile, only loading and rewriting the shards that are used. "sqlite" is
+        like "sharded", but keeps each top-level key in a row of a SQLite database named after the datafile.
+        :param threaded_writes: if True, saves are serialized and written from a background thread
+        :param lazy: if True, loaded data is only prepared for saving changes once it is accessed. Sharded data is
+        always lazy.
+        :param codec: the format to save the data in, from datacodecs.codec_options. Data saved in another format is
+        still read, and converted the next time it is saved. "journal" storage needs a json codec.
+        :param memory_map: if True, data files are decoded from a memory-mapped view instead of being read into memory
+        :param per_guild_keys: with "sqlite" storage, the top-level keys holding a dict keyed by guild id. Each guild in
+        them gets its own row, so changing one guild doesn't rewrite the others. They are still read all at once.
         """
+        if storage not in self.storage_options:
+            raise ValueError(f"Unknown storage option {storage}. Choose from {self.storage_options}.")
         if data_file_name is None:
            data_file_name = f"{self.__class__.__name__.lower()}_data"
         py_file_location = inspect.getfile(self.__class__)
         self.directory, _ = py_file_location.rsplit("\\", 1)
         data_file_location = self.directory + f"\\{data_file_name}.json"
-        self.data: dict = AutoSavingDict(data_file_location)
+        if storage == "sharded":
+            self.data: AutoSavingDict = ShardedAutoSavingDict(self.directory + f"\\{data_file_name}",
+                                                              write_behind_interval,
+                                                              threaded_writes=threaded_writes,
+                                                              migrate_from=data_file_location,
+                                                              codec=codec,
+                                                              memory_map=memory_map)
+        elif storage == "sqlite":
+            self.data: AutoSavingDict = SqliteAutoSavingDict(self.directory + f"\\{data_file_name}.sqlite3",
+                                                             write_behind_interval,
+                                                             threaded_writes=threaded_writes,
+                                                             migrate_from=data_file_location,
+                                                             codec=codec,
+                                                             per_guild_keys=per_guild_keys)
+        else:
+            codec_file_location = self.directory + f"\\{data_file_name}{datacodecs.get_codec(codec).extension}"
+            if not os.path.exists(codec_file_location) and os.path.exists(data_file_location):
+                # The existing datafile is read whatever format it's in, and rewritten in the new one when it's saved
+                os.replace(data_file_location, codec_file_location)
+            self.data: AutoSavingDict = AutoSavingDict(codec_file_location, write_behind_interval,
+                                                        journal=storage == "journal",
+                                                        threaded_writes=threaded_writes,
+                                                        lazy=lazy,
+                                                        codec=codec,
+                                                        memory_map=memory_map)
+
+    def cog_unload(self) -> None:
+        self.data.flush()
 
     def get_path(self, relative_path) -> str:
         return f"{self.directory}\\{relative_path}"
@@ -0,0 +1,75 @@
+import time
+from typing import Dict, Hashable, Optional
+
+
+class TokenBucket:
+    """
+    Allows up to capacity actions at once, refilling at rate actions per second.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        # A bucket can be made with a time after the one it's first used with, which mustn't take tokens away
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def take(self, now: Optional[float] = None) -> bool:
+        """
+        :return: True if there was a token to take, or False if the action should be suppressed
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self) -> None:
+        """
+        Return a token taken for an action that didn't happen after all.
+        """
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Cooldowns:
+    """
+    A TokenBucket for each key, made the first time the key is used. Buckets that have refilled are forgotten once
+    there are more than max_buckets of them, since a new one would behave the same.
+    """
+
+    def __init__(self, max_buckets: int = 10000):
+        self.max_buckets = max_buckets
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+    def take(self, key: Hashable, rate: float, capacity: float) -> bool:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.rate != rate or bucket.capacity != capacity:
+            if len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            bucket = TokenBucket(rate, capacity, now)
+            self._buckets[key] = bucket
+        return bucket.take(now)
+
+    def give_back(self, key: Hashable) -> None:
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.give_back()
+
+    def forget(self, key: Hashable) -> None:
+        self._buckets.pop(key, None)
+
+    def _prune(self, now: float) -> None:
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
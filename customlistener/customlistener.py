@@ -1,5 +1,7 @@
 import logging
-import re
+import math
+import time
+from typing import Dict, List, Tuple
 
 import nextcord
 import nextcord.ext.commands as commands
@@ -9,18 +11,46 @@ from nextcord.ext import application_checks
 from bot import Embedinator, StatiCat
 from checks import check_permissions, check_in_guild, check_in_private, is_owner_or_whitelist
 import interactions_checks
+from autosavedict import Change
 from cogwithdata import CogWithData
+from customlistener.cooldowns import Cooldowns
+from customlistener.matcher import ListenerIndex, UnsafeKeywordError, classify_keyword
 from interactions import SlashInteractionAliasContext
+from messagepipeline import MessageView
+from metrics import metric
 
 
 class CustomListener(CogWithData):
     _perms_to_check = ['administrator', 'manage_guild', 'manage_messages', 'kick_members', 'ban_members']
 
     def __init__(self, bot: StatiCat):
-        super().__init__()
+        super().__init__(write_behind_interval=5, storage="sharded", threaded_writes=True)
         self.bot = bot
         self.embedinator = Embedinator(**{"title": "**Custom Listeners**"})
         self.method_options = ["anywhere", "start", "end"]
+        # guild id -> the guild's listeners, indexed by channel
+        self._indexes: Dict[str, ListenerIndex] = {}
+        self._match_stats = {"messages": 0, "listeners_checked": 0, "total": 0.0, "max": 0.0, "last": 0.0,
+                             "over_budget": 0, "listeners_skipped": 0, "index_hits": 0, "index_misses": 0}
+        # How many seconds regex keywords can spend on a message before the rest are skipped
+        self.match_budget = 0.01
+        # How many times a listener can blow the budget before it is quarantined
+        self.quarantine_strikes = 3
+        # (guild id, listener name) -> [times it blew the budget, slowest search in seconds]
+        self._over_budget: Dict[Tuple[str, str], List] = {}
+        self.cooldowns = Cooldowns()
+        # Each channel can get channel_reply_burst replies at once, refilling at channel_reply_rate replies per second
+        self.channel_reply_rate = 0.5
+        self.channel_reply_burst = 5
+        self._reply_stats = {"replies": 0, "merged": 0, "suppressed_listener": 0, "suppressed_channel": 0}
+        self.data.subscribe((), self._invalidate_patterns)
+        # Only guilds with listeners need their messages checked
+        bot.message_pipeline.features.set_all("customlistener", self._guilds_with_listeners())
+        bot.message_pipeline.add_stage("CustomListener", self.handle_message, order=50, feature="customlistener")
+
+    def cog_unload(self) -> None:
+        self.bot.message_pipeline.remove_stage("CustomListener")
+        super().cog_unload()
 
     @commands.check_any(
         check_permissions(_perms_to_check, False),
@@ -61,15 +91,22 @@ class CustomListener(CogWithData):
         if method.lower() not in self.method_options:
             method = self.method_options[0]
 
+        try:
+            classify_keyword(keyword.lower())
+        except UnsafeKeywordError as e:
+            await ctx.send(f"I can't listen for that keyword. {e}")
+            return
+
         listener = {
             "keyword": keyword.lower(),
             "reaction": reaction,
             "method": method.lower(),
             "channel": ctx.channel.id if channel_specific else False
         }
-        if str(ctx.guild.id) not in self.data:
-            self.data[str(ctx.guild.id)] = {}
-        self.data[str(ctx.guild.id)][name] = listener
+        async with self.data.batch():
+            if str(ctx.guild.id) not in self.data:
+                self.data[str(ctx.guild.id)] = {}
+            self.data[str(ctx.guild.id)][name] = listener
 
         if isinstance(ctx, SlashInteractionAliasContext):
             await ctx.send(
@@ -162,6 +199,8 @@ class CustomListener(CogWithData):
         self.embedinator.add_line("Keyword: {}".format(listener["keyword"]))
         self.embedinator.add_line("Reaction: {}".format(listener["reaction"]))
         # self.embedinator.add_line("Method: {}".format(listener["method"]))
+        if listener.get("cooldown"):
+            self.embedinator.add_line("Cooldown: {} seconds".format(listener["cooldown"]))
         if ctx.channel.id == listener["channel"]:
             self.embedinator.add_line("Channel: {0.mention}".format(ctx.channel))
 
@@ -176,6 +215,38 @@ class CustomListener(CogWithData):
         """
         return await self.info_server(SlashInteractionAliasContext(interaction, self.bot, [name, ]), name)
 
+    @check_in_guild()
+    @custom_listeners.command("cooldown")
+    async def cooldown_server(self, ctx: commands.Context, name: str, seconds: float):
+        """
+        Set how long a listener waits before it can react again. Use 0 to remove the cooldown.
+        """
+        if not math.isfinite(seconds) or seconds < 0:
+            await ctx.send("The cooldown has to be a number of seconds that isn't negative.")
+            return
+        try:
+            listener = self.data[str(ctx.guild.id)][name]
+        except KeyError:
+            await ctx.send("There isn't a listener named {} for this server.".format(name))
+            return
+        if seconds == 0:
+            listener.pop("cooldown", None)
+            await ctx.send("Removed the cooldown from {}!".format(name))
+        else:
+            listener["cooldown"] = seconds
+            await ctx.send("{} will wait {} seconds between reactions!".format(name, seconds))
+
+    @slash_custom_listeners.subcommand(name="cooldown")
+    async def slash_cooldown_server(self, interaction: nextcord.Interaction, name: str, seconds: float):
+        """
+        Set how long a listener waits before it can react again.
+
+        :param name: The name of the listener
+        :param seconds: How many seconds to wait between reactions. Use 0 to remove the cooldown.
+        """
+        return await self.cooldown_server(SlashInteractionAliasContext(interaction, self.bot, [name, seconds]),
+                                          name, seconds)
+
     @custom_listeners.command("help")
     async def help_server(self, ctx: commands.Context):
         """
@@ -185,7 +256,7 @@ class CustomListener(CogWithData):
         if isinstance(prefix, list):
             prefix = prefix[0]
         self.embedinator.footer = f"Use {prefix}customlisteners <command> or /listeners <command> to use a command!"
-        self.embedinator.add_line("There are currently **4** subcommands available with for custom listeners:")
+        self.embedinator.add_line("There are currently **5** subcommands available with for custom listeners:")
         self.embedinator.add_line("**list** - List all of the commands defined for the current server.")
         self.embedinator.add_line("**info** - Display the information about the specified listener.")
         self.embedinator.add_line("⠀⠀<name> - The name of the listener, which you can find with `list`.")
@@ -197,6 +268,9 @@ class CustomListener(CogWithData):
             "⠀⠀[channel_specific=False] - Whether or not the listener only applies to the current channel. Defaults to False.")
         self.embedinator.add_line("**remove** - Remove a listener from the current server.")
         self.embedinator.add_line("⠀⠀<name> - The name of the listener, which you can find with `list`.")
+        self.embedinator.add_line("**cooldown** - Set how long a listener waits before reacting again.")
+        self.embedinator.add_line("⠀⠀<name> - The name of the listener, which you can find with `list`.")
+        self.embedinator.add_line("⠀⠀<seconds> - How many seconds to wait. Use 0 to remove the cooldown.")
         self.embedinator.add_line()
         self.embedinator.add_line("These commands only work in servers.")
         self.embedinator.add_line(
@@ -212,24 +286,160 @@ class CustomListener(CogWithData):
         """
         return await self.help_server(SlashInteractionAliasContext(interaction, self.bot))
 
-    def check_message(self, method: str, keyword: str, message: nextcord.Message):
-        pattern_string = r'\b(?P<key>' + keyword + r')\b'
-        if method == self.method_options[0]:
-            pattern = re.compile(pattern_string, re.IGNORECASE)
-        elif method == self.method_options[1]:
-            pattern = re.compile(r'^' + pattern_string, re.IGNORECASE)
+    @commands.is_owner()
+    @custom_listeners.command(name="stats", hidden=True)
+    async def stats(self, ctx: commands.Context):
+        """
+        How long matching messages against custom listeners is taking.
+        """
+        stats = self.match_stats()
+        lines = [f"Checked {stats['messages']} messages against {stats['listeners_checked']} listeners.",
+                 f"Average: {stats['average'] * 1000:.3f} ms, max: {stats['max'] * 1000:.3f} ms, "
+                 f"last: {stats['last'] * 1000:.3f} ms per message.",
+                 f"Compiled patterns cached for {stats['guilds_cached']} servers.",
+                 f"{stats['over_budget']} messages went over the {self.match_budget * 1000:.0f} ms budget, skipping "
+                 f"{stats['listeners_skipped']} listeners."]
+        replies = self._reply_stats
+        lines.append(f"Sent {replies['replies']} replies, merging {replies['merged']} reactions into them. "
+                     f"Suppressed {replies['suppressed_listener']} reactions for listener cooldowns and "
+                     f"{replies['suppressed_channel']} for channel cooldowns.")
+        slowest = sorted(self._over_budget.items(), key=lambda item: item[1][1], reverse=True)[:10]
+        for (guild_id, name), (strikes, worst) in slowest:
+            lines.append(f"> {name} in {guild_id}: over budget {strikes} times, slowest {worst * 1000:.3f} ms")
+        await ctx.send("\n".join(lines))
+
+    def cache_stats(self) -> Dict[str, Tuple[int, int]]:
+        return {"customlistener_index": (self._match_stats["index_hits"], self._match_stats["index_misses"])}
+
+    def collect_metrics(self) -> List[str]:
+        stats = self._match_stats
+        replies = self._reply_stats
+        return (metric("staticat_customlistener_messages", "counter", "Messages checked against custom listeners.",
+                         [({}, stats["messages"])])
+                + metric("staticat_customlistener_over_budget", "counter",
+                         "Messages whose regex keywords went over the matching budget.", [({}, stats["over_budget"])])
+                + metric("staticat_customlistener_replies_suppressed", "counter",
+                         "Reactions held back by cooldowns.",
+                         [({"cooldown": "listener"}, replies["suppressed_listener"]),
+                          ({"cooldown": "channel"}, replies["suppressed_channel"])]))
+
+    def match_stats(self) -> dict:
+        """
+        :return: how many messages have been checked against listeners, and how long it took per message, in seconds
+        """
+        stats = dict(self._match_stats)
+        stats["average"] = stats["total"] / stats["messages"] if stats["messages"] else 0.0
+        stats["guilds_cached"] = len(self._indexes)
+        return stats
+
+    def _guild_index(self, guild_id: str) -> ListenerIndex:
+        """
+        Get the index of a guild's listeners, building it the first time it is needed.
+        """
+        index = self._indexes.get(guild_id)
+        if index is None:
+            self._match_stats["index_misses"] += 1
+            index = ListenerIndex(self.data[guild_id])
+            self._indexes[guild_id] = index
         else:
-            pattern = re.compile(pattern_string + r'$', re.IGNORECASE)
-        return pattern.search(message.content) is not None
-
-    @commands.Cog.listener()
-    async def on_message(self, message: nextcord.Message):
-        if message.author.id != self.bot.user.id:
-            if message.guild is not None:
-                if str(message.guild.id) in self.data:
-                    for name, info in self.data[str(message.guild.id)].items():
-                        if message.channel.id == info["channel"] and self.check_message(info["method"], info["keyword"],
-                                                                                        message):
-                            await message.reply(info["reaction"])
-                        elif info["channel"] is False and self.check_message(info["method"], info["keyword"], message):
-                            await message.reply(info["reaction"])
+            self._match_stats["index_hits"] += 1
+        return index
+
+    def _guilds_with_listeners(self) -> List[int]:
+        # Shards are only loaded when they're used, so empty guilds count too
+        return [int(guild_id) for guild_id in self.data.keys() if str(guild_id).isdigit()]
+
+    def _invalidate_patterns(self, change: Change) -> None:
+        features = self.bot.message_pipeline.features
+        if not change.path:
+            features.set_all("customlistener", self._guilds_with_listeners())
+        elif str(change.path[0]).isdigit():
+            guild_id = change.path[0]
+            features.set(int(guild_id), "customlistener", guild_id in self.data and len(self.data[guild_id]) > 0)
+
+        if not change.path:
+            self._indexes.clear()
+            self._over_budget.clear()
+        elif len(change.path) == 1:
+            self._indexes.pop(change.path[0], None)
+            for key in [key for key in self._over_budget if key[0] == change.path[0]]:
+                del self._over_budget[key]
+        else:
+            self._over_budget.pop((change.path[0], change.path[1]), None)
+            if len(change.path) == 2:
+                self.cooldowns.forget((change.path[0], change.path[1]))
+            if change.path[0] in self._indexes:
+                # Only the listener that changed needs to be re-indexed
+                self._indexes[change.path[0]].update(change.path[1])
+
+    def _record_over_budget(self, guild_id: str, index: ListenerIndex, name: str, elapsed: float) -> None:
+        strikes = self._over_budget.setdefault((guild_id, name), [0, 0.0])
+        strikes[0] += 1
+        strikes[1] = max(strikes[1], elapsed)
+        logging.warning(f"Custom listener {name} in {guild_id} took {elapsed * 1000:.3f} ms to check a message.")
+        if strikes[0] >= self.quarantine_strikes and name not in index.quarantined:
+            logging.warning(f"Custom listener {name} in {guild_id} is too slow, and will be skipped until it is "
+                            f"changed.")
+            index.quarantine(name)
+
+    async def handle_message(self, view: MessageView):
+        message = view.message
+        if view.guild_id is not None:
+            if view.guild_key in self.data:
+                start = time.perf_counter()
+                guild_id = view.guild_key
+                index = self._guild_index(guild_id)
+                result = index.matches(view.content, view.channel_id, self.match_budget)
+                reactions = []
+                cooled = []
+                for name in result.names:
+                    info = index.listeners[name]
+                    cooldown = info.get("cooldown")
+                    if cooldown:
+                        if not self.cooldowns.take((guild_id, name), 1 / cooldown, 1):
+                            self._reply_stats["suppressed_listener"] += 1
+                            continue
+                        cooled.append((guild_id, name))
+                    reactions.append(info["reaction"])
+                self._record_match_time(time.perf_counter() - start, result.checked)
+                if result.over_budget or result.skipped:
+                    self._match_stats["over_budget"] += 1
+                    self._match_stats["listeners_skipped"] += result.skipped
+                    for name, elapsed in result.over_budget:
+                        self._record_over_budget(guild_id, index, name, elapsed)
+                if not reactions:
+                    return
+                if not self.cooldowns.take(("channel", view.channel_id), self.channel_reply_rate,
+                                           self.channel_reply_burst):
+                    self._reply_stats["suppressed_channel"] += len(reactions)
+                    # The listeners didn't get to reply, so they shouldn't have to wait out their cooldowns
+                    for key in cooled:
+                        self.cooldowns.give_back(key)
+                    return
+                replies = self._merge_reactions(reactions)
+                self._reply_stats["replies"] += len(replies)
+                self._reply_stats["merged"] += len(reactions) - len(replies)
+                for reply in replies:
+                    await message.reply(reply)
+
+    @staticmethod
+    def _merge_reactions(reactions: List[str], limit: int = 2000) -> List[str]:
+        """
+        Join the reactions to a message into as few replies as Discord's message length limit allows.
+        """
+        replies = []
+        for reaction in reactions:
+            if replies and len(replies[-1]) + 1 + len(reaction) <= limit:
+                replies[-1] += "\n" + reaction
+            else:
+                replies.append(reaction)
+        return replies
+
+    def _record_match_time(self, elapsed: float, listeners: int) -> None:
+        stats = self._match_stats
+        stats["messages"] += 1
+        stats["listeners_checked"] += listeners
+        stats["total"] += elapsed
+        stats["max"] = max(stats["max"], elapsed)
+        stats["last"] = elapsed
+        logging.debug(f"Matched a message against {listeners} custom listeners in {elapsed * 1000:.3f} ms")
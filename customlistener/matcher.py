@@ -0,0 +1,461 @@
+import logging
+import re
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+MAX_KEYWORD_LENGTH = 200
+MAX_REPEAT_COUNT = 100
+# The longest message Discord lets a bot see, which is how many ways an unbounded repeat can be tried
+MAX_MESSAGE_LENGTH = 4000
+# How many different ways a keyword can try to match from one position in a message. An unbounded repeat on its own
+# uses up MAX_MESSAGE_LENGTH of this, leaving room for a couple of small choices like (a|b) or u? around it.
+MAX_MATCH_PATHS = 4 * MAX_MESSAGE_LENGTH
+
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, "POSSESSIVE_REPEAT", None)}
+_BACKREFERENCES = {sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS, sre_constants.GROUPREF_IGNORE}
+
+
+class UnsafeKeywordError(ValueError):
+    """
+    A keyword that isn't a valid regex, or could backtrack for long enough to stall the bot.
+    """
+    pass
+
+
+def compile_keyword(method: str, keyword: str) -> re.Pattern:
+    """
+    Compile the regex that a listener's keyword is matched with.
+
+    :param method: "anywhere", "start" or "end"
+    """
+    pattern_string = r'\b(?P<key>' + keyword + r')\b'
+    if method == "start":
+        return re.compile(r'^' + pattern_string, re.IGNORECASE)
+    elif method == "end":
+        return re.compile(pattern_string + r'$', re.IGNORECASE)
+    return re.compile(pattern_string, re.IGNORECASE)
+
+
+def is_literal(keyword: str) -> bool:
+    """
+    Whether a keyword matches itself and nothing else, so it can be found without a regex.
+
+    Non-ASCII keywords are left to the regex, since casefolding doesn't always agree with re.IGNORECASE for them.
+    """
+    return keyword != "" and keyword.isascii() and not any(c in _REGEX_SPECIAL for c in keyword)
+
+
+def classify_keyword(keyword: str) -> str:
+    """
+    Check that a keyword is safe to match against every message in a guild.
+
+    Keywords that use regex syntax are restricted to patterns that can't backtrack catastrophically: no repeats inside
+    of other repeats, no choices inside repeats, no backreferences and no repeat counts over MAX_REPEAT_COUNT. Then the
+    ways every choice in the keyword (alternations, optional parts and repeats of varying length) can combine are
+    counted, and there can't be more than MAX_MATCH_PATHS of them. That rules out patterns like a*a*b or
+    a{0,100}a{0,100}b, which try every way of splitting a run of characters between their repeats. A repeat followed by
+    something it can't match, like the \w+ in \w+\s+, can only stop in one place, so it doesn't add any ways to match,
+    unless it comes straight after a repeat that can match the same characters, like the a* in a*a*b.
+
+    :return: "literal" if the keyword is plain text, or "regex" if it uses regex syntax
+    :raises UnsafeKeywordError: if the keyword is invalid or unsafe
+    """
+    if len(keyword) > MAX_KEYWORD_LENGTH:
+        raise UnsafeKeywordError(f"Keywords can't be longer than {MAX_KEYWORD_LENGTH} characters.")
+    if is_literal(keyword):
+        return "literal"
+    try:
+        compile_keyword("anywhere", keyword)
+        parsed = sre_parse.parse(r'\b(?P<key>' + keyword + r')\b', re.IGNORECASE)
+    except (re.error, RecursionError):
+        raise UnsafeKeywordError("That keyword isn't a valid regex.")
+    if _count_match_paths(parsed, False) > MAX_MATCH_PATHS:
+        raise UnsafeKeywordError("That keyword has too many ways to match, which could make it very slow. Try using "
+                                 "fewer repeats (like * or +) and optional parts next to each other.")
+    return "regex"
+
+
+def _count_match_paths(subpattern, in_repeat: bool) -> int:
+    """
+    Count the ways subpattern could try to match from one position, capped a little over MAX_MATCH_PATHS.
+
+    :raises UnsafeKeywordError: if part of subpattern could backtrack catastrophically
+    """
+    paths = 1
+    items = list(subpattern)
+    for i, (op, av) in enumerate(items):
+        if op in _REPEATS:
+            low, high, body = av
+            repeats = high > 1
+            if high != sre_constants.MAXREPEAT and high > MAX_REPEAT_COUNT:
+                raise UnsafeKeywordError(f"Keywords can't repeat anything more than {MAX_REPEAT_COUNT} times.")
+            if repeats and in_repeat:
+                raise UnsafeKeywordError("Keywords can't repeat something that is already repeated, like (a+)+.")
+            if repeats and any(child_op is sre_constants.BRANCH for child_op, _ in _flatten(body)):
+                raise UnsafeKeywordError("Keywords can't repeat a choice between alternatives, like (a|b)+.")
+            if in_repeat and low != high:
+                raise UnsafeKeywordError("Keywords can't repeat something optional, like (ab?)+.")
+            if i + 1 < len(items) and _stops_repeat(body, items[i + 1]) and \
+                    not (i > 0 and _follows_overlapping_repeat(body, items[i - 1])):
+                # Only one length can be followed by the next part, so the others fail straight away
+                choices = 1
+            elif high == sre_constants.MAXREPEAT:
+                choices = MAX_MESSAGE_LENGTH
+            else:
+                choices = high - low + 1
+            paths *= choices * _count_match_paths(body, in_repeat or repeats)
+        elif op in _BACKREFERENCES:
+            raise UnsafeKeywordError("Keywords can't use backreferences.")
+        elif op is sre_constants.SUBPATTERN:
+            paths *= _count_match_paths(av[-1], in_repeat)
+        elif op is sre_constants.BRANCH:
+            if in_repeat:
+                raise UnsafeKeywordError("Keywords can't repeat a choice between alternatives, like (a|b)+.")
+            paths *= sum(_count_match_paths(branch, in_repeat) for branch in av[1])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            paths *= _count_match_paths(av[1], in_repeat)
+        elif op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            paths *= _count_match_paths(av, in_repeat)
+        # Stop before the count gets huge, since it only needs to be compared with MAX_MATCH_PATHS
+        paths = min(paths, MAX_MATCH_PATHS + 1)
+    return paths
+
+
+# Characters that are checked when working out whether two parts of a keyword can match the same character
+_SAMPLE_CHARACTERS = [chr(c) for c in range(0x3000)]
+_CATEGORIES = {sre_constants.CATEGORY_DIGIT: r"\d", sre_constants.CATEGORY_NOT_DIGIT: r"\D",
+               sre_constants.CATEGORY_SPACE: r"\s", sre_constants.CATEGORY_NOT_SPACE: r"\S",
+               sre_constants.CATEGORY_WORD: r"\w", sre_constants.CATEGORY_NOT_WORD: r"\W"}
+
+
+def _character_set(op, av) -> Optional[frozenset]:
+    """
+    The sample characters that a single character part of a keyword matches, ignoring case.
+
+    :return: None if the part isn't a single character
+    """
+    if op is sre_constants.LITERAL:
+        matches = {chr(av)}
+    elif op is sre_constants.NOT_LITERAL:
+        matches = set(_SAMPLE_CHARACTERS) - {chr(av).lower(), chr(av).upper()}
+    elif op is sre_constants.ANY:
+        matches = set(_SAMPLE_CHARACTERS) - {"\n"}
+    elif op is sre_constants.IN:
+        matches = set()
+        negate = False
+        for item_op, item_av in av:
+            if item_op is sre_constants.NEGATE:
+                negate = True
+            elif item_op is sre_constants.LITERAL:
+                matches.add(chr(item_av))
+            elif item_op is sre_constants.RANGE:
+                matches.update(chr(c) for c in range(item_av[0], min(item_av[1], len(_SAMPLE_CHARACTERS) - 1) + 1))
+            elif item_op is sre_constants.CATEGORY and item_av in _CATEGORIES:
+                category = re.compile(_CATEGORIES[item_av])
+                matches.update(c for c in _SAMPLE_CHARACTERS if category.match(c))
+            else:
+                return None
+        if negate:
+            matches = set(_SAMPLE_CHARACTERS) - matches - {c.swapcase() for c in matches}
+    else:
+        return None
+    return frozenset(matches | {c.swapcase() for c in matches})
+
+
+def _stops_repeat(body, following) -> bool:
+    """
+    Whether a repeat of body has to stop where the part of the keyword following it starts, because that part always
+    takes a character that body can't match.
+    """
+    if len(body) != 1:
+        return False
+    repeated = _character_set(*body[0])
+    op, av = following
+    if op in _REPEATS:
+        low, high, following_body = av
+        if low == 0 or len(following_body) != 1:
+            return False
+        op, av = following_body[0]
+    next_character = _character_set(op, av)
+    return repeated is not None and next_character is not None and not repeated & next_character
+
+
+def _follows_overlapping_repeat(body, previous) -> bool:
+    """
+    Whether a repeat of body comes straight after a repeat of varying length that can match some of the same
+    characters, so each way of splitting a run between the two has to be tried.
+    """
+    op, av = previous
+    if op not in _REPEATS or av[0] == av[1]:
+        return False
+    repeated = _body_characters(body)
+    previous_characters = _body_characters(av[2])
+    return repeated is None or previous_characters is None or bool(repeated & previous_characters)
+
+
+def _body_characters(body) -> Optional[frozenset]:
+    """
+    The sample characters that anything in body matches, ignoring case.
+
+    :return: None if body has a part that isn't a single character
+    """
+    characters = frozenset()
+    for op, av in _flatten(body):
+        if op is sre_constants.SUBPATTERN or op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            continue
+        matches = _character_set(op, av)
+        if matches is None:
+            return None
+        characters |= matches
+    return characters
+
+
+def _flatten(subpattern):
+    """
+    Every (op, av) in subpattern, including the ones inside of groups.
+    """
+    for op, av in subpattern:
+        yield op, av
+        if op is sre_constants.SUBPATTERN:
+            yield from _flatten(av[-1])
+        elif op is getattr(sre_constants, "ATOMIC_GROUP", None):
+            yield from _flatten(av)
+
+
+class MatchResult(NamedTuple):
+    # The listeners that were triggered, in the order they were added
+    names: List[str]
+    # How many listeners the message was checked against
+    checked: int
+    # The regex listeners that were running when the time budget ran out, and how long their search took
+    over_budget: List[Tuple[str, float]]
+    # How many regex listeners weren't checked because the time budget ran out
+    skipped: int
+
+
+def _is_word(text: str, i: int) -> bool:
+    # The same characters that \w matches
+    return 0 <= i < len(text) and (text[i].isalnum() or text[i] == "_")
+
+
+class _Automaton:
+    """
+    An Aho-Corasick automaton, which finds every occurrence of a set of keywords in one pass over a text.
+    """
+
+    def __init__(self, keywords: List[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # The ids of the keywords that end at each node, including through fail links
+        self.output: List[List[int]] = [[]]
+        self.lengths = [len(keyword) for keyword in keywords]
+        for keyword_id, keyword in enumerate(keywords):
+            node = 0
+            for c in keyword:
+                if c not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][c] = len(self.goto) - 1
+                node = self.goto[node][c]
+            self.output[node].append(keyword_id)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for c, child in self.goto[node].items():
+                queue.append(child)
+                if node != 0:
+                    fallback = self.fail[node]
+                    while fallback and c not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[child] = self.goto[fallback].get(c, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str):
+        """
+        :return: (keyword id, start, end) for every occurrence of a keyword in text
+        """
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        node = 0
+        for end, c in enumerate(text, 1):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for keyword_id in output[node]:
+                yield keyword_id, end - self.lengths[keyword_id], end
+
+
+class ListenerMatcher:
+    """
+    Finds every custom listener in a guild that a message triggers.
+
+    Plain keywords are all found in a single scan of the message, and keywords that use regex syntax are checked with
+    their own compiled pattern.
+    """
+
+    def __init__(self, listeners: Dict[str, dict]):
+        """
+        :param listeners: listener name -> listener info, as saved by CustomListener
+        """
+        self.names = list(listeners)
+        self.listeners = listeners
+        keywords: List[str] = []
+        keyword_ids: Dict[str, int] = {}
+        # keyword id -> the listeners with that keyword, as (position in self.names, method)
+        self._literal_listeners: List[List[Tuple[int, str]]] = []
+        self._patterns: List[Tuple[int, re.Pattern]] = []
+        for position, (name, info) in enumerate(listeners.items()):
+            keyword, method = info["keyword"], info["method"]
+            if is_literal(keyword):
+                keyword = keyword.lower()
+                if keyword not in keyword_ids:
+                    keyword_ids[keyword] = len(keywords)
+                    keywords.append(keyword)
+                    self._literal_listeners.append([])
+                self._literal_listeners[keyword_ids[keyword]].append((position, method))
+                continue
+            try:
+                classify_keyword(keyword)
+            except UnsafeKeywordError as e:
+                logging.warning(f"Custom listener {name} will be skipped: {e}")
+                continue
+            self._patterns.append((position, compile_keyword(method, keyword)))
+        self._keywords = keywords
+        self._automaton = _Automaton(keywords)
+
+    def __len__(self):
+        return len(self.names)
+
+    def matches(self, content: str, deadline: Optional[float] = None) -> MatchResult:
+        """
+        :param deadline: if set, the time.perf_counter() time to stop checking regex listeners at. Plain keywords are
+        always checked, since they only take one pass over content.
+        """
+        triggered = set()
+        lowered = content.casefold()
+        if len(lowered) != len(content):
+            # Casefolding changed where characters are, so the literal matches can't be lined up with the message
+            for keyword, entries in zip(self._keywords, self._literal_listeners):
+                for position, method in entries:
+                    if compile_keyword(method, keyword).search(content):
+                        triggered.add(position)
+            lowered = ""
+
+        for keyword_id, start, end in self._automaton.find(lowered):
+            # The same checks as the \b, ^ and $ around a keyword's regex
+            if _is_word(content, start - 1) == _is_word(content, start) \
+                    or _is_word(content, end - 1) == _is_word(content, end):
+                continue
+            for position, method in self._literal_listeners[keyword_id]:
+                if method == "start" and start != 0:
+                    continue
+                if method == "end" and end != len(content) and not (end == len(content) - 1 and content[-1] == "\n"):
+                    continue
+                triggered.add(position)
+        over_budget = []
+        skipped = 0
+        for i, (position, pattern) in enumerate(self._patterns):
+            if deadline is None:
+                if pattern.search(content):
+                    triggered.add(position)
+                continue
+            start = time.perf_counter()
+            if start >= deadline:
+                skipped = len(self._patterns) - i
+                break
+            if pattern.search(content):
+                triggered.add(position)
+            end = time.perf_counter()
+            if end > deadline:
+                over_budget.append((self.names[position], end - start))
+        return MatchResult([self.names[position] for position in sorted(triggered)], len(self), over_budget, skipped)
+
+
+class ListenerIndex:
+    """
+    Keeps a guild's listeners grouped by the channel they apply to, with a ListenerMatcher for each group, so a message
+    is only checked against the server-wide listeners and the ones for its own channel.
+    """
+
+    def __init__(self, listeners: Dict[str, dict]):
+        """
+        :param listeners: listener name -> listener info, as saved by CustomListener. This should be the saved dict
+        itself, so update() can see changes to it.
+        """
+        self.listeners = listeners
+        # channel id, or None for server-wide -> the names of the listeners for it
+        self._scopes: Dict[Optional[int], Dict[str, None]] = {}
+        self._scope_of: Dict[str, Optional[int]] = {}
+        self._order: Dict[str, int] = {}
+        self._next_position = 0
+        self._matchers: Dict[Optional[int], ListenerMatcher] = {}
+        self.quarantined = set()
+        for name in listeners:
+            self.update(name)
+
+    def update(self, name: str) -> None:
+        """
+        Re-index a listener after it was added, changed or removed.
+        """
+        # A changed listener keeps its place, like it does in the dict, and gets another chance if it was quarantined
+        self.quarantined.discard(name)
+        position = self._order.pop(name, None)
+        if name in self._scope_of:
+            scope = self._scope_of.pop(name)
+            del self._scopes[scope][name]
+            if not self._scopes[scope]:
+                del self._scopes[scope]
+            self._matchers.pop(scope, None)
+        info = self.listeners.get(name)
+        if info is None:
+            return
+        if position is None:
+            position = self._next_position
+            self._next_position += 1
+        scope = info["channel"] if info["channel"] is not False else None
+        self._scopes.setdefault(scope, {})[name] = None
+        self._scope_of[name] = scope
+        self._order[name] = position
+        self._matchers.pop(scope, None)
+
+    def quarantine(self, name: str) -> None:
+        """
+        Stop checking messages against a listener until it is changed.
+        """
+        if name in self._scope_of:
+            self.quarantined.add(name)
+            self._matchers.pop(self._scope_of[name], None)
+
+    def _matcher(self, scope: Optional[int]) -> ListenerMatcher:
+        matcher = self._matchers.get(scope)
+        if matcher is None:
+            matcher = ListenerMatcher({name: self.listeners[name] for name in self._scopes[scope]
+                                       if name not in self.quarantined})
+            self._matchers[scope] = matcher
+        return matcher
+
+    def matches(self, content: str, channel_id: int, budget: Optional[float] = None) -> MatchResult:
+        """
+        Find the listeners that a message in channel_id triggers.
+
+        :param budget: if set, how many seconds to spend on regex listeners before skipping the rest
+        """
+        deadline = time.perf_counter() + budget if budget is not None else None
+        result = MatchResult([], 0, [], 0)
+        for scope in (None, channel_id):
+            if scope in self._scopes:
+                scope_result = self._matcher(scope).matches(content, deadline)
+                result = MatchResult(*(total + part for total, part in zip(result, scope_result)))
+        result.names.sort(key=self._order.__getitem__)
+        return result
@@ -1,13 +1,13 @@
 import logging
 from typing import Union
 
-import nextcord
 import nextcord.ext.commands as commands
 import requests
 from lxml import html
 
 from bot import StatiCat
 from cogwithdata import CogWithData
+from messagepipeline import MessageView
 from random import random
 
 class Dad(CogWithData):
@@ -18,6 +18,21 @@ class Dad(CogWithData):
         self.bot = bot
         self.funny_chance = 0.04
         self.dad_chance = 0.15
+        bot.message_pipeline.features.register("dad", default=True)
+        self._update_features()
+        self.data.subscribe(("blacklist",), lambda change: self._update_features())
+        bot.message_pipeline.add_stage("Dad", self.handle_message, order=60, feature="dad")
+
+    def cog_unload(self) -> None:
+        self.bot.message_pipeline.remove_stage("Dad")
+        super().cog_unload()
+
+    def _update_features(self) -> None:
+        # Every guild gets the jokes unless it's blacklisted
+        features = self.bot.message_pipeline.features
+        features.set_all("dad", [])
+        for guild_id in self.data.get("blacklist", []):
+            features.set(guild_id, "dad", False)
 
     @commands.command()
     async def dadjoke(self, ctx):
@@ -34,9 +49,10 @@ class Dad(CogWithData):
         """
         Disables the funny I'm StatiCat joke for this server.
         """
-        if "blacklist" not in self.data:
-            self.data["blacklist"] = []
-        self.data["blacklist"].append(ctx.guild.id)
+        async with self.data.batch():
+            if "blacklist" not in self.data:
+                self.data["blacklist"] = []
+            self.data["blacklist"].append(ctx.guild.id)
         await ctx.send("No longer responding with the classic joke.")
 
     @commands.command(name="startdad")
@@ -44,39 +60,34 @@ class Dad(CogWithData):
         """
         Enables the funny I'm StatiCat joke for this server.
         """
-        if "blacklist" not in self.data:
-            self.data["blacklist"] = []
-        if ctx.guild.id in self.data["blacklist"]:
-            self.data["blacklist"].remove(ctx.guild.id)
+        async with self.data.batch():
+            if "blacklist" not in self.data:
+                self.data["blacklist"] = []
+            if ctx.guild.id in self.data["blacklist"]:
+                self.data["blacklist"].remove(ctx.guild.id)
         await ctx.send("Time to become funny.")
 
-    @commands.Cog.listener()
-    async def on_message(self, message: nextcord.Message):
-        if message.author.id == self.bot.user.id:
-            return
-        if message.guild is None:
+    async def handle_message(self, view: MessageView):
+        message = view.message
+        if view.guild_id is None:
             return
         else:
-            if message.guild.id in self.data["blacklist"]:
+            if view.guild_id in self.data["blacklist"]:
                return
 
-        content: str = message.content
-        channel = message.channel
-        guild = message.guild
-        nickname = guild.get_member(self.bot.user.id).display_name
-        if message.author.id != self.bot.user.id:
-            for word in content.split(" "):
-                if word.endswith("er") and random() < self.funny_chance:
-                    if word == "her" and random() >= self.funny_chance:
-                        continue
-                    # if random() < 0.5:
-                    await message.reply(f"\"{word}\"? I hardly even know her!")
-                    # else:
-                    #     await message.reply(f"\"{word}\"!? It's 2021. Keep it to \"{word[:-2]}a\", please.")
-                    return
-                
-        if random() < self.dad_chance and (content.lower().startswith("i'm ") or content.lower().startswith(
-                'im ') or content.lower().startswith('i am ')):
+        content: str = view.content
+        for word in view.tokens:
+            if word.endswith("er") and random() < self.funny_chance:
+                if word == "her" and random() >= self.funny_chance:
+                    continue
+                # if random() < 0.5:
+                await message.reply(f"\"{word}\"? I hardly even know her!")
+                # else:
+                #     await message.reply(f"\"{word}\"!? It's 2021. Keep it to \"{word[:-2]}a\", please.")
+                return
+            
+        if random() < self.dad_chance and view.lowered.startswith(("i'm ", 'im ', 'i am ')):
+            nickname = message.guild.get_member(self.bot.user.id).display_name
             nameStart = content.find('m') + 1
             nameEnd = content.find('.')
             if nameEnd > 0:
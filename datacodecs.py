@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+from typing import Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class JsonCodec:
+    """
+    Saves data with the standard library's json module.
+    """
+    name = "json"
+    extension = ".json"
+
+    def dumps(self, data) -> bytes:
+        return json.dumps(data).encode()
+
+    def loads(self, raw: Buffer):
+        if isinstance(raw, mmap.mmap):
+            # json can't read from a buffer, so a memory-mapped file is copied and saves nothing
+            raw = raw[:]
+        return json.loads(raw)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Saves data as json with orjson, which is much faster than the json module. Non-string keys are turned into strings
+    the same way json does it.
+
+    orjson saves NaN and infinity as null. It can't read them either, so files that have them (saved with the json
+    codec) are read with the json module instead.
+    """
+    name = "orjson"
+
+    def dumps(self, data) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, raw: Buffer):
+        try:
+            if isinstance(raw, mmap.mmap):
+                with memoryview(raw) as view:
+                    return orjson.loads(view)
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return super().loads(raw)
+
+
+class MsgpackCodec:
+    """
+    Saves data in the compact msgpack binary format. Unlike json, keys keep their types.
+    """
+    name = "msgpack"
+    extension = ".msgpack"
+
+    def dumps(self, data) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: Buffer):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+
+def get_codec(name: str):
+    """
+    :param name: "json", "orjson" or "msgpack". orjson falls back to json when it isn't installed.
+    :raises ValueError: if there is no codec with that name
+    :raises ImportError: if msgpack is asked for but isn't installed
+    """
+    if name == "json":
+        return JsonCodec()
+    if name == "orjson":
+        if orjson is None:
+            logging.warning("orjson isn't installed, so data will be saved with json instead.")
+            return JsonCodec()
+        return OrjsonCodec()
+    if name == "msgpack":
+        if msgpack is None:
+            raise ImportError("msgpack needs to be installed to save data in the msgpack format.")
+        return MsgpackCodec()
+    raise ValueError(f"Unknown codec {name}. Choose from {codec_options}.")
+
+
+codec_options = ["json", "orjson", "msgpack"]
+
+
+def codec_for_extension(extension: str, codec=None):
+    """
+    Get the codec to read data saved with a file extension.
+
+    :param codec: the codec the data is saved with now, which is used if it writes that extension
+    """
+    if codec is not None and codec.extension == extension:
+        return codec
+    if extension == MsgpackCodec.extension:
+        return get_codec("msgpack")
+    return JsonCodec()
+
+
+def detect_codec(raw: Buffer, codec=None):
+    """
+    Figure out which format a whole data file is in. This only works because a data file is always a dict, so a scalar
+    saved on its own has to be read with the codec it was saved with.
+
+    :param codec: the codec the data is saved with now, which is used if it can read the data. Json written by something
+    else is read with the json module, since orjson is stricter.
+    """
+    if bytes(raw[:64]).lstrip()[:1] in (b"{", b"["):
+        return codec if isinstance(codec, JsonCodec) else JsonCodec()
+    return codec if isinstance(codec, MsgpackCodec) else get_codec("msgpack")
+
+
+def read_file(location: str, memory_map: bool = False, codec=None, detect: bool = True) -> Tuple[object, str]:
+    """
+    Read and decode a saved data file, whatever format it's in.
+
+    :param memory_map: if True, decode straight from a memory-mapped view of the file instead of reading it into
+    memory first. Only orjson and msgpack can do that. The json module still makes a full copy.
+    :param codec: see detect_codec
+    :param detect: whether to work out the format from the contents, which only works for whole data files. If False,
+    the file is read with codec.
+    :return: the decoded data, and a digest of the file's contents
+    """
+    with open(location, 'rb') as file:
+        if memory_map and os.fstat(file.fileno()).st_size > 0:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+                return (detect_codec(raw, codec) if detect else codec).loads(raw), digest(raw)
+        raw = file.read()
+    return (detect_codec(raw, codec) if detect else codec).loads(raw), digest(raw)
+
+
+def digest(raw: Buffer) -> str:
+    return hashlib.sha1(raw).hexdigest()
@@ -21,6 +21,7 @@ from tiktokapipy.async_api import AsyncTikTokAPI, TikTokAPIError
 from tiktokapipy.models.video import Video
 
 from bot import StatiCat
+from messagepipeline import MessageView
 
 
 def get_tiktok_cookies():
@@ -47,6 +48,11 @@ class ExtractVid(commands.Cog):
             # re.compile("^https://www.tiktok.com/@[a-zA-Z0-9_.]+/video/[0-9]+\S*$"), self.extract_from_tiktok_long)
         }
         self.agent = UserAgent().chrome
+        # Downloading a video is slow, so every other stage gets to respond first
+        bot.message_pipeline.add_stage("ExtractVid", self.handle_message, order=90)
+
+    def cog_unload(self) -> None:
+        self.bot.message_pipeline.remove_stage("ExtractVid")
 
     @staticmethod
     def _validate_link_format(link: str, re_format: re.Pattern) -> bool:
@@ -137,9 +143,11 @@ class ExtractVid(commands.Cog):
             except TikTokAPIError as e:
                 return e
 
-    @commands.Cog.listener()
-    async def on_message(self, message: nextcord.Message):
-        content: str = message.content
+    async def handle_message(self, view: MessageView):
+        if not view.urls:
+            return
+        message = view.message
+        content: str = view.content
         channel: nextcord.TextChannel = message.channel
         author: nextcord.User = message.author
 
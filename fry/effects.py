@@ -0,0 +1,102 @@
+import numpy as np
+
+
+def bulge_pixels(img_data: np.ndarray, f, r: int, a: float, h: float, ior: float) -> np.ndarray:
+    """
+    Creates a fisheye distortion on an image's pixels, working on the whole square enclosing the bulge at once.
+
+    :param img_data: the image as a height x width x channels array
+    :param f: the [x, y] centre of the bulge
+    :param r: the radius of the bulge
+    :param a: the flatness of the bulge
+    :param h: the height of the bulge
+    :param ior: the index of refraction of the bulge
+    :return: a bulged copy of img_data
+    """
+    height, width = img_data.shape[:2]
+    fx, fy = int(f[0]), int(f[1])
+
+    # determine range of pixels to be checked (square enclosing bulge), max exclusive
+    x_min = max(int(f[0] - r), 0)
+    x_max = min(int(f[0] + r), width)
+    y_min = max(int(f[1] - r), 0)
+    y_max = min(int(f[1] + r), height)
+
+    bulged = np.copy(img_data)
+    if x_min >= x_max or y_min >= y_max:
+        return bulged
+    ys, xs = np.meshgrid(np.arange(y_min, y_max, dtype=np.int64), np.arange(x_min, x_max, dtype=np.int64),
+                         indexing="ij")
+
+    # displacement from the ray to the focus in the xy plane, and its magnitude
+    dx = fx - xs
+    dy = fy - ys
+    s = np.sqrt(dx * dx + dy * dy)
+
+    # rays in the centre of the bulge or beyond the radius don't need to be modified
+    inside = (0 < s) & (s < r)
+    dx, dy, s = dx[inside], dy[inside], s[inside]
+    ray_x, ray_y = xs[inside], ys[inside]
+
+    # slope of the bulge relative to xy plane at (x, y) of each ray
+    depth = np.sqrt(r ** 2 - s ** 2)
+    m = -s / (a * depth)
+
+    # find the angle between each ray and the normal of the bulge
+    theta = np.pi / 2 + np.arctan(1 / m)
+
+    # find the magnitude of the angle between xy plane and refracted ray using snell's law
+    # s >= 0 -> m <= 0 -> arctan(-1/m) > 0, but ray is below xy plane so we want a negative angle
+    # arctan(-1/m) is therefore negated
+    phi = np.abs(np.arctan(1 / m) - np.arcsin(np.sin(theta) / ior))
+
+    # find length each ray travels in xy plane before hitting z=0
+    k = (h + (depth / a)) / np.sin(phi)
+
+    # find intersection points
+    intersect_x = ray_x + (dx / s) * k
+    intersect_y = ray_y + (dy / s) * k
+
+    # assign pixels with the rays' coordinates the colour of the pixels at the intersections, or black if they miss
+    hits = (0 < intersect_x) & (intersect_x < width - 1) & (0 < intersect_y) & (intersect_y < height - 1)
+    bulged[ray_y[hits], ray_x[hits]] = img_data[intersect_y[hits].astype(np.intp), intersect_x[hits].astype(np.intp)]
+    bulged[ray_y[~hits], ray_x[~hits]] = 0
+    return bulged
+
+
+def noise_curve(factor: float) -> np.ndarray:
+    """
+    :return: each of the 256 levels scaled by its own random amount, within factor / 2 of 1
+    """
+    return np.arange(256) * (1 + np.random.random(256) * factor - factor / 2)
+
+
+def contrast_curve(level: float) -> np.ndarray:
+    """
+    :param level: how much to stretch levels away from the middle grey, from -255 to 255
+    """
+    factor = (259 * (level + 255)) / (255 * (259 - level))
+    return 128 + factor * (np.arange(256) - 128)
+
+
+def fuse_curves(bands: int, *curves) -> np.ndarray:
+    """
+    Combine tone curves into a single lookup table for each band. Each curve's output is rounded and clipped to 0-255
+    the same way Image.point does, so applying the fused table gives the same result as applying every curve in turn.
+
+    :param curves: each either 256 values used for every band, or a bands x 256 array with a curve for each band. They
+    are applied in the order given.
+    :return: a bands x 256 table
+    """
+    table = np.tile(np.arange(256), (bands, 1))
+    for curve in curves:
+        levels = np.broadcast_to(np.clip(np.rint(curve), 0, 255).astype(np.intp), (bands, 256))
+        table = np.take_along_axis(levels, table, axis=1)
+    return table
+
+
+def apply_curves(img, *curves):
+    """
+    Apply tone curves to a PIL image in one pass. See fuse_curves.
+    """
+    return img.point(fuse_curves(len(img.getbands()), *curves).ravel().tolist())
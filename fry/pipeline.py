@@ -0,0 +1,346 @@
+import asyncio
+import functools
+import hashlib
+import io
+import math
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+import cv2
+import dlib
+import numpy as np
+from PIL import Image
+from imutils import face_utils
+
+from fry.effects import apply_curves, bulge_pixels, contrast_curve, noise_curve
+
+# Loaded once in each worker process by _init_worker
+_directory = 'fry/'
+_detector = None
+_predictor = None
+# Overlay file name -> the decoded image
+_assets: Dict[str, Image.Image] = {}
+ASSETS = ['b.png', 'laughing_emoji.png', 'flare.png']
+
+# Faces are looked for in a copy of the image shrunk to about this many pixels. Landmarks are still found at full size.
+DETECTION_PIXELS = 1_000_000
+# image content hash -> the faces found in it, most recently used last
+_detections: "OrderedDict[tuple, List[Tuple[int, int, int, int]]]" = OrderedDict()
+_max_detections = 64
+
+
+def _init_worker(directory: str) -> None:
+    global _directory, _detector, _predictor
+    _directory = directory
+    _detector = dlib.get_frontal_face_detector()
+    _predictor = dlib.shape_predictor(directory + 'shape_predictor_68_face_landmarks.dat')
+    for name in ASSETS:
+        asset(name)
+
+
+def asset(name: str) -> Image.Image:
+    """
+    Get an overlay, decoding it the first time it's needed. Callers mustn't modify it.
+    """
+    image = _assets.get(name)
+    if image is None:
+        image = Image.open(_directory + name)
+        image.load()
+        _assets[name] = image
+    return image
+
+
+@functools.lru_cache(maxsize=256)
+def resized_asset(name: str, size: Tuple[int, int]) -> Image.Image:
+    """
+    Get an overlay shrunk to fit in size, keeping its aspect ratio. Callers mustn't modify it.
+    """
+    resized = asset(name).copy()
+    resized.thumbnail(size, Image.LANCZOS)
+    return resized
+
+
+def fry_bytes(image_data: bytes, do_buldge: bool) -> bytes:
+    """
+    The job that runs in a worker process. Images go in and out encoded, since that's cheaper to pickle.
+
+    :return: the fried image as a png
+    """
+    img = Image.open(io.BytesIO(image_data)).convert('RGB')
+    img = fry(img, do_buldge)
+    output = io.BytesIO()
+    img.save(output, "PNG")
+    return output.getvalue()
+
+
+def fry(img, do_buldge):
+    eyecoords = find_eyes(img)
+    img = add_flares(img, eyecoords)
+    coords = find_chars(img)
+    img = add_b_emojis(img, coords)
+    img = add_laughing_emojis(img, 5)
+
+    if (do_buldge):
+        # bulge at random coordinates
+        [w, h] = [img.width - 1, img.height - 1]
+        w *= np.random.random(1)
+        h *= np.random.random(1)
+        r = int(((img.width + img.height) / 10) * (np.random.random(1)[0] + 1))
+        img = bulge(img, np.array([int(w), int(h)]), r, 3, 5, 1.8)
+
+    # some finishing touches
+    img = apply_curves(img, noise_curve(0.2), contrast_curve(200))
+
+    return img
+
+
+def find_chars(img):
+    gray = np.array(img.convert("L"))
+    ret, mask = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)
+    image_final = cv2.bitwise_and(gray, gray, mask=mask)
+    ret, new_img = cv2.threshold(image_final, 180, 255, cv2.THRESH_BINARY_INV)
+    kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    dilated = cv2.dilate(new_img, kernel, iterations=1)
+    # Image.fromarray(dilated).save('out.png') # for debugging
+    contours = []
+    hierarchy = None
+    cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, contours, hierarchy)
+
+    coords = []
+    for contour in contours:
+        # get rectangle bounding contour
+        [x, y, w, h] = cv2.boundingRect(contour)
+        # ignore large chars (probably not chars)
+        if w > 70 and h > 70:
+            continue
+        coords.append((x, y, w, h))
+    return coords
+
+
+def add_b_emojis(img, coords):
+    # create a temporary copy if img
+    tmp = img.copy()
+
+    for coord in coords:
+        if np.random.random(1)[0] < 0.1:
+            resized = resized_asset('b.png', (coord[2], coord[3]))
+            tmp.paste(resized, (int(coord[0]), int(coord[1])), resized)
+
+    return tmp
+
+
+def add_laughing_emojis(img, max):
+    # create a temporary copy if img
+    tmp = img.copy()
+
+    for i in range(int(np.random.random(1)[0] * max)):
+        # add laughing emoji to random coordinates
+        coord = np.random.random(2) * np.array([img.width, img.height])
+
+        size = int((img.width / 10) * (np.random.random(1)[0] + 1))
+        resized = resized_asset('laughing_emoji.png', (size, size))
+        tmp.paste(resized, (int(coord[0]), int(coord[1])), resized)
+
+    return tmp
+
+
+def find_eyes(img):
+    coords = []
+    gray = np.array(img.convert("L"))
+
+    # detect faces in the grayscale image
+    rects = cached_face_rects(gray, _detector)
+
+    # loop over the face detections
+    for (i, rect) in enumerate(rects):
+        # determine the facial landmarks for the face region, then
+        # convert the landmark (x, y)-coordinates to a NumPy array
+        shape = _predictor(gray, dlib.rectangle(*rect))
+        shape = face_utils.shape_to_np(shape)
+
+        coords.append(average_point(shape[36:42]))
+        coords.append(average_point(shape[42:48]))
+
+    return coords
+
+
+def face_rects(gray: np.ndarray, detector, detection_pixels: Optional[int] = DETECTION_PIXELS) \
+        -> List[Tuple[int, int, int, int]]:
+    """
+    Find faces with the HOG detector, on a copy of the image shrunk to about detection_pixels if it is bigger.
+
+    :param detection_pixels: None to look at the full size image
+    :return: the (left, top, right, bottom) of each face, in the full size image's coordinates
+    """
+    height, width = gray.shape[:2]
+    scale = 1.0
+    if detection_pixels is not None and width * height > detection_pixels:
+        scale = math.sqrt(detection_pixels / (width * height))
+        gray = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
+    return [(round(rect.left() / scale), round(rect.top() / scale), round(rect.right() / scale),
+             round(rect.bottom() / scale)) for rect in detector(gray, 1)]
+
+
+def cached_face_rects(gray: np.ndarray, detector, detection_pixels: Optional[int] = DETECTION_PIXELS) \
+        -> List[Tuple[int, int, int, int]]:
+    """
+    face_rects, remembering the faces found in the last few images this process has seen, so frying the same image
+    again skips detection.
+    """
+    key = (hashlib.blake2b(gray.tobytes(), digest_size=16).digest(), gray.shape, detection_pixels)
+    rects = _detections.get(key)
+    if rects is None:
+        rects = face_rects(gray, detector, detection_pixels)
+        _detections[key] = rects
+        if len(_detections) > _max_detections:
+            _detections.popitem(last=False)
+    else:
+        _detections.move_to_end(key)
+    return rects
+
+
+def add_flares(img, coords):
+    # create a temporary copy if img
+    tmp = img.copy()
+
+    # add flares to temporary copy
+    flare = asset('flare.png')
+    for coord in coords:
+        tmp.paste(flare, (int(coord[0] - flare.size[0] / 2), int(coord[1] - flare.size[1] / 2)), flare)
+
+    return tmp
+
+
+# Creates a fisheye distortion on img at f[x,y], with radius r, flatness a, height h, and index of refraction ior
+def bulge(img, f, r, a, h, ior):
+    # ignore too large images
+    if img.width * img.height > 3000 * 3000:
+        return img
+
+    return Image.fromarray(bulge_pixels(np.array(img), f, r, a, h, ior))
+
+
+def average_point(points):
+    x_avg = 0
+    y_avg = 0
+    for x, y in points:
+        x_avg += x
+        y_avg += y
+    x_avg /= len(points)
+    y_avg /= len(points)
+    return x_avg, y_avg
+
+
+class FryQueueFullError(Exception):
+    pass
+
+
+class FryPool:
+    """
+    Fries images in worker processes, so the event loop never waits on dlib or PIL.
+
+    At most workers images are fried at once, and up to max_queued more wait their turn in order. A job that takes
+    longer than timeout seconds has its workers killed, since a process can't be interrupted any other way. Any other
+    job running at the time fails too, and a fresh set of workers is started for the next one.
+    """
+
+    def __init__(self, directory: str, workers: int = 2, max_queued: int = 8, timeout: float = 60):
+        """
+        :param directory: where the fry assets and the dlib shape predictor are
+        """
+        self.directory = directory
+        self.workers = workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._running = 0
+        self._waiting: Deque[asyncio.Future] = deque()
+        self.timeouts = 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiting)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Spawn the workers, since forking the bot would copy its threads' locks mid-use
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_worker, initargs=(self.directory,))
+        return self._executor
+
+    async def fry(self, image_data: bytes, do_buldge: bool,
+                  on_queued: Optional[Callable[[int], Awaitable[None]]] = None) -> bytes:
+        """
+        :param image_data: the encoded image to fry
+        :param on_queued: called with the job's place in line if it has to wait for a worker
+        :return: the fried image as a png
+        :raises FryQueueFullError: if max_queued jobs are already waiting
+        :raises asyncio.TimeoutError: if the job took longer than timeout seconds
+        """
+        await self._acquire(on_queued)
+        try:
+            executor = self._get_executor()
+            job = executor.submit(fry_bytes, image_data, do_buldge)
+        except BaseException:
+            self._release()
+            raise
+        # The worker is only free again once the job is actually done, even if whoever was waiting for it has given up
+        loop = asyncio.get_running_loop()
+        job.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if not job.cancelled():
+                self._kill(executor)
+            raise
+
+    async def _acquire(self, on_queued: Optional[Callable[[int], Awaitable[None]]]) -> None:
+        if self._running < self.workers and not self._waiting:
+            self._running += 1
+            return
+        if len(self._waiting) >= self.max_queued:
+            raise FryQueueFullError(f"There are already {len(self._waiting)} images waiting to be fried.")
+        turn = asyncio.get_running_loop().create_future()
+        self._waiting.append(turn)
+        try:
+            if on_queued is not None:
+                await on_queued(len(self._waiting))
+            await turn
+        except BaseException:
+            if turn.done() and not turn.cancelled():
+                # The worker was handed over just as this gave up, so pass it on
+                self._release()
+            elif turn in self._waiting:
+                self._waiting.remove(turn)
+            raise
+
+    def _release(self) -> None:
+        while self._waiting:
+            turn = self._waiting.popleft()
+            if not turn.done():
+                # Hand the worker straight to the next job in line
+                turn.set_result(None)
+                return
+        self._running -= 1
+
+    def _kill(self, executor: ProcessPoolExecutor) -> None:
+        if self._executor is executor:
+            self._executor = None
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self) -> None:
+        for turn in self._waiting:
+            turn.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -2,6 +2,7 @@ import abc
 import asyncio
 import inspect
 import logging
+import time
 import traceback
 from typing import Type, Union, Any, Optional, List
 
@@ -9,6 +10,7 @@ from nextcord.ext.commands import Command, Cog, CheckFailure
 from nextcord.ext.commands._types import Check
 
 from bot import StatiCat
+from lagmonitor import running_handler
 import nextcord
 import nextcord.ext.commands as commands
 from cogwithdata import CogWithData
@@ -240,9 +242,15 @@ class ApplicationCommandHandler(InteractionHandler, _type=nextcord.InteractionTy
         command = available_commands.get((target_name, target_type), None)
         if command is None:
             return
+        cog_name = command.cog.qualified_name if command.cog is not None else "Bot"
+        start = time.perf_counter()
+        failed = True
         try:
             command.pre_check(self.interaction)
-            return await command.invoke(self.interaction)
+            with running_handler(f"{cog_name}./{command.command_name}"):
+                result = await command.invoke(self.interaction)
+            failed = False
+            return result
         except CheckFailure:
             if self.interaction.response.is_done():
                 await self.interaction.followup.send(content="You don't have permission to use that command here.", ephemeral=True)
@@ -250,6 +258,10 @@ class ApplicationCommandHandler(InteractionHandler, _type=nextcord.InteractionTy
                 await self.interaction.response.send_message(content="You don't have permission to use that command here.", ephemeral=True)
         except Exception as error:
             logging.exception("Failed to invoke an Application Command.", exc_info=error)
+        finally:
+            latency = getattr(command.bot, "handler_latency", None)
+            if latency is not None:
+                latency.record(cog_name, "/" + command.command_name, time.perf_counter() - start, failed)
 
 
 class MessageComponentHandler(InteractionHandler, _type=nextcord.InteractionType.component):
@@ -0,0 +1,199 @@
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional
+
+_PROJECT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Task -> the command or listener it is running. A contextvar can't be read from the watchdog thread, but the task the
+# loop is stuck in can be.
+_running_handlers: Dict[asyncio.Task, str] = {}
+
+
+@contextlib.contextmanager
+def running_handler(name: str) -> Iterator[None]:
+    """
+    Mark the current task as running a command or listener until the block exits, so stalls in it are blamed on it.
+
+    :param name: the handler's name, like "Fry.fryimg"
+    """
+    task = asyncio.current_task()
+    if task is None:
+        yield
+        return
+    previous = _running_handlers.get(task)
+    _running_handlers[task] = name
+    try:
+        yield
+    finally:
+        if previous is None:
+            _running_handlers.pop(task, None)
+        else:
+            _running_handlers[task] = previous
+
+
+class LagHistogram:
+    """
+    Counts samples into buckets by their upper bound, in seconds.
+    """
+
+    bounds = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")]
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        :return: the upper bound of the bucket that the given fraction of samples fall under
+        """
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+        return self.max
+
+
+class Stall(NamedTuple):
+    # When the stall was noticed, as a time.time()
+    when: float
+    # How long the loop had been blocked for when its stack was captured
+    blocked_for: float
+    # The command or listener that was running, if it's known, and the project function it had got to, like
+    # "Fry.fryimg at autosavedict.AutoSavingDict._timed_write"
+    culprit: str
+    stack: str
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a callback that should run every interval seconds, and watches for the loop
+    being blocked from a separate thread.
+
+    When the loop has been blocked for longer than threshold seconds, the stack of whatever is blocking it is captured
+    and logged, along with the command or listener it came from.
+    """
+
+    def __init__(self, interval: float = 0.25, threshold: float = 0.5, max_stalls: int = 20):
+        """
+        :param interval: how often to sample the loop, in seconds
+        :param threshold: how long the loop can be blocked before its stack is captured, in seconds
+        :param max_stalls: how many captured stalls to keep
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = LagHistogram()
+        self.stalls: Deque[Stall] = deque(maxlen=max_stalls)
+        # Every stall seen, including ones that have dropped out of stalls
+        self.stall_count = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """
+        Start monitoring the running event loop. This has to be called from the loop's thread.
+        """
+        if self.running:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._loop = asyncio.get_running_loop()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._sample())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            self.histogram.add(max(0.0, loop.time() - start - self.interval))
+
+    def _watch(self) -> None:
+        captured_for = None
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold:
+                continue
+            if captured_for == heartbeat:
+                # Already captured this stall
+                continue
+            captured_for = heartbeat
+            self._capture(blocked_for)
+
+    def _capture(self, blocked_for: float) -> None:
+        self.stall_count += 1
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        frames = traceback.extract_stack(frame)
+        culprit = _find_culprit(frame)
+        handler = _running_handlers.get(asyncio.current_task(self._loop))
+        if handler is not None:
+            culprit = f"{handler} at {culprit}"
+        stall = Stall(time.time(), blocked_for, culprit, "".join(traceback.format_list(frames)))
+        self.stalls.append(stall)
+        logging.warning(f"The event loop has been blocked for {blocked_for:.3f} seconds by {culprit}:\n{stall.stack}")
+
+    def summary(self) -> List[str]:
+        histogram = self.histogram
+        average = histogram.total / histogram.count if histogram.count else 0.0
+        return [f"Loop lag over {histogram.count} samples: average {average * 1000:.1f} ms, "
+                f"p50 {histogram.percentile(0.5) * 1000:.1f} ms, p99 {histogram.percentile(0.99) * 1000:.1f} ms, "
+                f"max {histogram.max * 1000:.1f} ms",
+                " ".join(f"≤{bound * 1000:g}ms: {count}" for bound, count in zip(histogram.bounds, histogram.counts)
+                         if count)]
+
+
+def _find_culprit(frame) -> str:
+    """
+    Name the innermost function from this project in a stack, skipping this module.
+    """
+    innermost = None
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_PROJECT_DIRECTORY + os.sep) and filename.endswith(".py") \
+                and filename != os.path.abspath(__file__):
+            module = os.path.relpath(filename, _PROJECT_DIRECTORY)[:-len(".py")].replace(os.sep, ".")
+            return f"{module}.{getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}"
+        if innermost is None:
+            innermost = f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return innermost or "unknown"
@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from lagmonitor import LagHistogram, running_handler
+
+
+class HandlerLatency:
+    """
+    Call and error counts for a handler, a histogram of how long it takes, and its most recent durations for working
+    out percentiles.
+    """
+
+    def __init__(self, samples: int):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: Deque[float] = deque(maxlen=samples)
+        self.histogram = LagHistogram()
+
+    def record(self, elapsed: float, error: bool) -> None:
+        self.calls += 1
+        self.errors += error
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.recent.append(elapsed)
+        self.histogram.add(elapsed)
+
+    def percentiles(self, *fractions: float) -> List[float]:
+        ordered = sorted(self.recent)
+        if not ordered:
+            return [0.0 for _ in fractions]
+        return [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for fraction in fractions]
+
+
+class LatencyRegistry:
+    """
+    Keeps a HandlerLatency for every (cog, handler) that has been timed. Recording only appends to a deque, and the
+    percentiles are worked out when they're asked for.
+    """
+
+    def __init__(self, samples: int = 512):
+        """
+        :param samples: how many recent durations to keep per handler
+        """
+        self.samples = samples
+        self._handlers: Dict[Tuple[str, str], HandlerLatency] = {}
+        self._log_task: Optional[asyncio.Task] = None
+
+    def record(self, cog: str, handler: str, elapsed: float, error: bool = False) -> None:
+        latency = self._handlers.get((cog, handler))
+        if latency is None:
+            latency = HandlerLatency(self.samples)
+            self._handlers[(cog, handler)] = latency
+        latency.record(elapsed, error)
+
+    def wrap(self, cog: str, handler: str, func):
+        """
+        :return: a coroutine function that calls func, recording how long it takes and whether it raises
+        """
+
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with running_handler(f"{cog}.{handler}"):
+                    result = await func(*args, **kwargs)
+            except BaseException:
+                self.record(cog, handler, time.perf_counter() - start, True)
+                raise
+            self.record(cog, handler, time.perf_counter() - start)
+            return result
+
+        return timed
+
+    def handlers(self) -> Dict[Tuple[str, str], HandlerLatency]:
+        return dict(self._handlers)
+
+    def snapshot(self) -> Dict[Tuple[str, str], dict]:
+        """
+        :return: (cog, handler) -> calls, errors, and the p50, p95, p99 and max durations in seconds
+        """
+        stats = {}
+        for key, latency in list(self._handlers.items()):
+            p50, p95, p99 = latency.percentiles(0.5, 0.95, 0.99)
+            stats[key] = {"calls": latency.calls, "errors": latency.errors, "total": latency.total, "p50": p50,
+                          "p95": p95, "p99": p99, "max": latency.max}
+        return stats
+
+    def summary(self, count: int = 10) -> List[str]:
+        """
+        :return: a line for each of the count handlers that have taken the most time in total
+        """
+        stats = sorted(self.snapshot().items(), key=lambda item: item[1]["total"], reverse=True)[:count]
+        return [f"{cog}.{handler}: {s['calls']} calls, {s['errors']} errors, p50 {s['p50'] * 1000:.1f} ms, "
+                f"p95 {s['p95'] * 1000:.1f} ms, p99 {s['p99'] * 1000:.1f} ms, max {s['max'] * 1000:.1f} ms"
+                for (cog, handler), s in stats]
+
+    def start_logging(self, interval: float) -> None:
+        """
+        Log a summary every interval seconds. This has to be called from the event loop.
+        """
+        if self._log_task is not None and not self._log_task.done():
+            return
+        self._log_task = asyncio.get_running_loop().create_task(self._log_periodically(interval))
+
+    def stop_logging(self) -> None:
+        if self._log_task is not None:
+            self._log_task.cancel()
+            self._log_task = None
+
+    async def _log_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            lines = self.summary(5)
+            if lines:
+                logging.info("Slowest handlers: " + " | ".join(lines))
@@ -0,0 +1,209 @@
+import logging
+import re
+import time
+from functools import cached_property
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import nextcord
+
+from lagmonitor import running_handler
+from latency import LatencyRegistry
+
+_URL_PATTERN = re.compile(r"https?://\S+")
+
+
+class MessageView:
+    """
+    The parts of a message that several cogs look at, worked out at most once per message.
+    """
+
+    def __init__(self, message: nextcord.Message):
+        self.message = message
+        self.content: str = message.content
+        self.guild_id: Optional[int] = message.guild.id if message.guild is not None else None
+        self.channel_id: int = message.channel.id
+        self.author_id: int = message.author.id
+        self.author_is_bot: bool = message.author.bot
+
+    @cached_property
+    def guild_key(self) -> Optional[str]:
+        """
+        The guild id as a string, the way it's saved as a key in a json datafile.
+        """
+        return str(self.guild_id) if self.guild_id is not None else None
+
+    @cached_property
+    def lowered(self) -> str:
+        return self.content.lower()
+
+    @cached_property
+    def tokens(self) -> List[str]:
+        """
+        The words in the message, split on single spaces the way Dad always has, so a newline doesn't end a word.
+        """
+        return self.content.split(" ")
+
+    @cached_property
+    def urls(self) -> List[str]:
+        return _URL_PATTERN.findall(self.content)
+
+
+class GuildFeatures:
+    """
+    A bitmap for each guild of which features it uses, so whole stages can be skipped for guilds that don't need them.
+
+    Each feature gets a bit and a default, which guilds use until their bit is set explicitly. Cogs keep their features
+    up to date as their data changes.
+    """
+
+    def __init__(self):
+        self._bits: Dict[str, int] = {}
+        self._defaults = 0
+        # guild id -> the bits that have been set explicitly, and what they were set to
+        self._explicit: Dict[int, int] = {}
+        self._values: Dict[int, int] = {}
+
+    def register(self, feature: str, default: bool = False) -> int:
+        """
+        Add a feature, or reset it if it already exists.
+
+        :param default: whether guilds that haven't been set explicitly have the feature
+        :return: the feature's bit
+        """
+        bit = self._bits.get(feature)
+        if bit is None:
+            bit = 1 << len(self._bits)
+            self._bits[feature] = bit
+        self._defaults = self._defaults | bit if default else self._defaults & ~bit
+        for guild_id in list(self._explicit):
+            self._explicit[guild_id] &= ~bit
+            self._values[guild_id] &= ~bit
+        return bit
+
+    def bit(self, feature: str) -> int:
+        return self._bits[feature]
+
+    def set(self, guild_id: int, feature: str, enabled: bool) -> None:
+        """
+        Set whether a guild has a feature, overriding the default.
+        """
+        bit = self._bits[feature]
+        self._explicit[guild_id] = self._explicit.get(guild_id, 0) | bit
+        values = self._values.get(guild_id, 0)
+        self._values[guild_id] = values | bit if enabled else values & ~bit
+
+    def set_all(self, feature: str, enabled_guilds: Iterable[int]) -> None:
+        """
+        Reset a feature, so that exactly enabled_guilds have it and every other guild uses the default. The feature is
+        registered with a default of False if it doesn't exist yet.
+        """
+        default = bool(self._defaults & self._bits.get(feature, 0))
+        self.register(feature, default)
+        for guild_id in enabled_guilds:
+            self.set(guild_id, feature, True)
+
+    def has(self, guild_id: Optional[int], bit: int) -> bool:
+        explicit = self._explicit.get(guild_id, 0)
+        return bool(((self._values.get(guild_id, 0) & explicit) | (self._defaults & ~explicit)) & bit)
+
+
+# A stage returns True to stop the stages after it from seeing the message
+MessageStageCallback = Callable[[MessageView], Awaitable[Optional[bool]]]
+
+
+class MessageStage(NamedTuple):
+    name: str
+    callback: MessageStageCallback
+    order: int
+    # The GuildFeatures bit a guild needs for the stage to run, or 0 to always run it
+    feature_bit: int
+
+
+class MessagePipeline:
+    """
+    Runs every message through the registered stages in order, instead of every cog listening for messages on its own.
+
+    Stages with a lower order run first. Stages that filter messages out (like silencing someone) should come early,
+    and slow stages (like downloading a video) should come last.
+    """
+
+    def __init__(self, latency: Optional[LatencyRegistry] = None):
+        """
+        :param latency: if set, each stage's timings are also recorded in it as the stage's on_message handler
+        """
+        self._stages: List[MessageStage] = []
+        self._stats: Dict[str, dict] = {}
+        self.features = GuildFeatures()
+        self.invocations_avoided = 0
+        self.latency = latency
+
+    def add_stage(self, name: str, callback: MessageStageCallback, order: int = 50,
+                  feature: Optional[str] = None) -> None:
+        """
+        :param name: a unique name for the stage, used to remove it and in its timing stats
+        :param callback: an async function that takes a MessageView, and returns True to stop the message there
+        :param order: where the stage runs, relative to the others
+        :param feature: if set, the stage is skipped for messages from guilds without this feature in self.features,
+        including messages that aren't from a guild unless the feature is on by default. It must be registered first.
+        """
+        self.remove_stage(name)
+        feature_bit = self.features.bit(feature) if feature is not None else 0
+        self._stages.append(MessageStage(name, callback, order, feature_bit))
+        self._stages.sort(key=lambda stage: stage.order)
+        self._stats[name] = {"calls": 0, "skipped": 0, "stopped": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                             "last": 0.0}
+
+    def remove_stage(self, name: str) -> None:
+        self._stages = [stage for stage in self._stages if stage.name != name]
+        self._stats.pop(name, None)
+
+    @property
+    def stages(self) -> List[MessageStage]:
+        return list(self._stages)
+
+    async def dispatch(self, message: nextcord.Message) -> MessageView:
+        view = MessageView(message)
+        for stage in list(self._stages):
+            stats = self._stats.get(stage.name)
+            if stage.feature_bit and not self.features.has(view.guild_id, stage.feature_bit):
+                self.invocations_avoided += 1
+                if stats is not None:
+                    stats["skipped"] += 1
+                continue
+            start = time.perf_counter()
+            stop = False
+            failed = False
+            try:
+                with running_handler(f"{stage.name}.on_message"):
+                    stop = await stage.callback(view)
+            except Exception as error:
+                failed = True
+                if stats is not None:
+                    stats["errors"] += 1
+                logging.error(f"Error in the {stage.name} message stage.",
+                              exc_info=(type(error), error, error.__traceback__))
+            elapsed = time.perf_counter() - start
+            if self.latency is not None:
+                self.latency.record(stage.name, "on_message", elapsed, failed)
+            if stats is not None:
+                stats["calls"] += 1
+                stats["total"] += elapsed
+                stats["max"] = max(stats["max"], elapsed)
+                stats["last"] = elapsed
+            if stop:
+                if stats is not None:
+                    stats["stopped"] += 1
+                break
+        return view
+
+    def stage_stats(self) -> Dict[str, dict]:
+        """
+        :return: stage name -> how many messages it saw, skipped, stopped and errored on, and how long it took in
+        seconds, in the order the stages run
+        """
+        stats = {}
+        for stage in self._stages:
+            stage_stats = dict(self._stats[stage.name])
+            stage_stats["average"] = stage_stats["total"] / stage_stats["calls"] if stage_stats["calls"] else 0.0
+            stats[stage.name] = stage_stats
+        return stats
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from autosavedict import AutoSavingDict
+from lagmonitor import LagHistogram
+
+# A sample's labels and value
+Sample = Tuple[Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+    if label_text:
+        name = f"{name}{{{label_text}}}"
+    if math.isnan(value):
+        return f"{name} NaN"
+    if math.isinf(value):
+        return f"{name} {'+Inf' if value > 0 else '-Inf'}"
+    return f"{name} {value!r}"
+
+
+def metric(name: str, kind: str, description: str, samples: Iterable[Sample]) -> List[str]:
+    """
+    Format a metric family in the Prometheus text format.
+
+    :param kind: "gauge" or "counter"
+    :param samples: (labels, value) pairs. Counters should leave off the _total suffix, since it is added here.
+    """
+    if kind == "counter":
+        name += "_total"
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+    lines.extend(_format_sample(name, labels, value) for labels, value in samples)
+    return lines
+
+
+def histogram(name: str, description: str, histograms: Iterable[Tuple[Dict[str, str], LagHistogram]]) -> List[str]:
+    """
+    Format a LagHistogram for each set of labels as a Prometheus histogram.
+    """
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for labels, values in histograms:
+        seen = 0
+        for bound, count in zip(values.bounds, values.counts):
+            seen += count
+            lines.append(_format_sample(f"{name}_bucket", {**labels, "le": "+Inf" if math.isinf(bound) else bound},
+                                        seen))
+        lines.append(_format_sample(f"{name}_sum", labels, values.total))
+        lines.append(_format_sample(f"{name}_count", labels, values.count))
+    return lines
+
+
+class MetricsServer:
+    """
+    Serves the bot's metrics in the Prometheus text format over HTTP, on the bot's event loop.
+
+    Cogs can report their caches with a cache_stats method that returns cache name -> (hits, misses), and their worker
+    pools with a worker_queue_depths method that returns pool name -> queued jobs. Anything else can be added with a
+    collect_metrics method that returns lines made with metric() or histogram().
+    """
+
+    def __init__(self, bot, host: str = "127.0.0.1", port: int = 9108):
+        """
+        :param bot: the StatiCat to report on
+        :param host: the address to listen on. Keep this local unless the scraper is on another machine.
+        """
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def running(self) -> bool:
+        return self._server is not None
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Skip the headers, since there's no body to find the length of
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                await self._respond(writer, "405 Method Not Allowed", b"")
+            elif parts[1].split("?")[0] not in ("/", "/metrics"):
+                await self._respond(writer, "404 Not Found", b"")
+            else:
+                body = self.render().encode("utf-8")
+                await self._respond(writer, "200 OK", body, include_body=parts[0] == "GET")
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            logging.exception("Failed to serve metrics.")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, body: bytes, include_body: bool = True) -> None:
+        writer.write(f"HTTP/1.1 {status}\r\n"
+                     f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1"))
+        if include_body:
+            writer.write(body)
+        await writer.drain()
+
+    def render(self) -> str:
+        lines = []
+        bot = self.bot
+        gateway = bot.latency
+        if math.isfinite(gateway):
+            lines += metric("staticat_gateway_latency_seconds", "gauge",
+                            "Time between the last gateway heartbeat and its acknowledgement.", [({}, gateway)])
+        lines += histogram("staticat_event_loop_lag_seconds", "How late the event loop ran a timer.",
+                           [({}, bot.lag_monitor.histogram)])
+        lines += metric("staticat_event_loop_stalls", "counter", "Times the event loop was blocked for too long.",
+                        [({}, bot.lag_monitor.stall_count)])
+
+        handlers = bot.handler_latency.handlers()
+        lines += histogram("staticat_handler_duration_seconds", "How long commands and listeners take.",
+                           [({"cog": cog, "handler": handler}, latency.histogram)
+                            for (cog, handler), latency in handlers.items()])
+        lines += metric("staticat_handler_errors", "counter", "Commands and listeners that failed.",
+                        [({"cog": cog, "handler": handler}, latency.errors)
+                         for (cog, handler), latency in handlers.items()])
+
+        stores = [("global", bot.global_data)]
+        for name, cog in bot.cogs.items():
+            data = getattr(cog, "data", None)
+            if isinstance(data, AutoSavingDict):
+                stores.append((name, data))
+        stats = [({"store": name}, data.save_stats()) for name, data in stores]
+        lines += metric("staticat_store_writes", "counter", "Saves made by each AutoSavingDict.",
+                        [(labels, s["saves"]) for labels, s in stats])
+        lines += metric("staticat_store_written_bytes", "counter", "Bytes written by each AutoSavingDict.",
+                        [(labels, s["bytes_written"]) for labels, s in stats])
+        lines += metric("staticat_store_writes_coalesced", "counter",
+                        "Changes folded into a pending write-behind save instead of saving on their own.",
+                        [(labels, s["writes_coalesced"]) for labels, s in stats])
+        lines += metric("staticat_store_blocking_seconds", "counter",
+                        "Time saves have blocked the event loop for.",
+                        [(labels, s["blocking_total"]) for labels, s in stats])
+
+        queue_depths = {"saves": AutoSavingDict.save_queue_depth()}
+        caches = {}
+        extra = []
+        for name, cog in list(bot.cogs.items()):
+            try:
+                if hasattr(cog, "worker_queue_depths"):
+                    queue_depths.update(cog.worker_queue_depths())
+                if hasattr(cog, "cache_stats"):
+                    caches.update(cog.cache_stats())
+                if hasattr(cog, "collect_metrics"):
+                    extra += cog.collect_metrics()
+            except Exception:
+                logging.exception(f"Failed to collect metrics from {name}.")
+        lines += metric("staticat_worker_queue_depth", "gauge", "Jobs waiting for a worker.",
+                        [({"pool": pool}, depth) for pool, depth in queue_depths.items()])
+        lines += metric("staticat_cache_hits", "counter", "Lookups that found what they needed already built.",
+                        [({"cache": cache}, hits) for cache, (hits, misses) in caches.items()])
+        lines += metric("staticat_cache_misses", "counter", "Lookups that had to build what they needed.",
+                        [({"cache": cache}, misses) for cache, (hits, misses) in caches.items()])
+        lines += metric("staticat_cache_hit_ratio", "gauge", "The fraction of lookups that were hits.",
+                        [({"cache": cache}, hits / (hits + misses)) for cache, (hits, misses) in caches.items()
+                         if hits + misses])
+        return "\n".join(lines + extra) + "\n"
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+from datetime import datetime
 from typing import Optional
 
 import nextcord
@@ -76,6 +77,59 @@ class Owner(commands.Cog):
         """
         await ctx.send(getattr(self.bot, attribute))
 
+    @commands.is_owner()
+    @commands.command(name="pipeline")
+    async def send_pipeline_stats(self, ctx: commands.Context):
+        """
+        Sends how long each stage of the message pipeline is taking.
+        """
+        lines = []
+        for name, stats in self.bot.message_pipeline.stage_stats().items():
+            lines.append(f"**{name}**: {stats['calls']} messages, average {stats['average'] * 1000:.3f} ms, "
+                         f"max {stats['max'] * 1000:.3f} ms, skipped {stats['skipped']}, stopped {stats['stopped']}, "
+                         f"errors {stats['errors']}")
+        lines.append(f"Skipped {self.bot.message_pipeline.invocations_avoided} stages for servers that don't use them.")
+        await ctx.send("\n".join(lines))
+
+    @commands.is_owner()
+    @commands.command(name="lag")
+    async def send_lag(self, ctx: commands.Context, stack: Optional[int] = None):
+        """
+        Sends how far behind the event loop has been running, and what has been blocking it.
+
+        Give the number of a stall to see its full stack.
+        """
+        monitor = self.bot.lag_monitor
+        stalls = list(monitor.stalls)
+        if stack is not None:
+            if not 1 <= stack <= len(stalls):
+                await ctx.send(f"There are only {len(stalls)} stalls recorded.")
+                return
+            text = stalls[-stack].stack
+            # Keep the innermost frames if the stack is too long for one message
+            await ctx.send(f"```\n{text[-1900:]}\n```")
+            return
+        lines = monitor.summary()
+        lines.append(f"Stalls over {monitor.threshold * 1000:.0f} ms, most recent first:")
+        for i, stall in enumerate(reversed(stalls), 1):
+            lines.append(f"{i}. {datetime.fromtimestamp(stall.when):%m/%d %H:%M:%S} blocked "
+                         f"{stall.blocked_for * 1000:.0f}+ ms by {stall.culprit}")
+        await ctx.send("\n".join(lines))
+
+    @commands.is_owner()
+    @commands.command(name="latency")
+    async def send_latency(self, ctx: commands.Context, count: int = 10):
+        """
+        Sends how long the commands and listeners that have taken the most time in total are taking.
+        """
+        lines = self.bot.handler_latency.summary(count)
+        if not lines:
+            await ctx.send("Nothing has been timed yet.")
+            return
+        # Cut it down to one message
+        text = "\n".join(lines)
+        await ctx.send(text[:2000])
+
     def approval_check(self, event: nextcord.RawReactionActionEvent):
         return event.user_id == self.bot.owner_id and event.emoji.name in ('👍', 'thumbsup')
 
@@ -3,7 +3,7 @@ import os
 import re
 import traceback
 from random import choice, random
-from typing import Union
+from typing import Optional, Union
 import subprocess
 
 import nextcord
@@ -11,26 +11,68 @@ import nextcord.ext.commands as commands
 from nextcord import slash_command, message_command
 import pyttsx3
 
+from autosavedict import Change
 from bot import StatiCat
 from checks import check_permissions, check_in_guild
 from cogwithdata import CogWithData
+from messagepipeline import MessageView
+
+_RATIO_PATTERN = re.compile(r'\b(?:ratio|ratiod|ratioed)\b', re.IGNORECASE)
+_ATTACKS = ("silence", "mimic", "mock")
 
 
 class Rude(CogWithData):
     def __init__(self, bot: StatiCat):
-        super().__init__()
+        super().__init__(write_behind_interval=5, storage="sqlite", threaded_writes=True,
+                         per_guild_keys=("mimic", "silence", "mock"))
         self.bot = bot
         self.beta_male_video = self.get_path("beta_male.mov")
         self.beta_male_audio = self.get_path("beta_male_audio.mov")
         self.counter_ratio_chance = 0.05
+        self._update_features()
+        self.data.subscribe((), self._update_features)
+        # Silencing deletes the message, so this runs before the other cogs see it
+        bot.message_pipeline.add_stage("Rude", self.handle_message, order=10, feature="rude")
+        bot.message_pipeline.add_stage("Ratio", self.handle_ratio, order=40)
+
+    def cog_unload(self) -> None:
+        self.bot.message_pipeline.remove_stage("Rude")
+        self.bot.message_pipeline.remove_stage("Ratio")
+        super().cog_unload()
+
+    def _update_features(self, change: Optional[Change] = None) -> None:
+        # Only guilds with someone to silence, mimic or mock need their messages checked
+        features = self.bot.message_pipeline.features
+        if change is not None and change.path and change.path[0] not in _ATTACKS:
+            return
+        if change is not None and len(change.path) >= 2:
+            # Only the guild that changed needs to be checked again
+            if str(change.path[1]).isdigit():
+                features.set(int(change.path[1]), "rude", self._is_targeted(int(change.path[1])))
+            return
+        targeted = set()
+        for attack in _ATTACKS:
+            for guild_id, targets in self.data.get(attack, {}).items():
+                if targets and str(guild_id).isdigit():
+                    targeted.add(int(guild_id))
+        features.set_all("rude", targeted)
+
+    def _is_targeted(self, guild_id: int) -> bool:
+        # Guild ids are ints until the data is reloaded, when they become strings
+        for attack in _ATTACKS:
+            targets = self.data.get(attack, {})
+            if targets.get(guild_id) or targets.get(str(guild_id)):
+                return True
+        return False
 
     async def _add_target(self, attack: str, ctx: commands.Context, target: Union[nextcord.Member, nextcord.User]):
         if target.id is self.bot.user.id:
             await ctx.send(f"I can't {attack} myself.")
             return
-        if ctx.guild.id not in self.data[attack]:
-            self.data[attack][ctx.guild.id] = []
-        self.data[attack][ctx.guild.id].append(target.id)
+        async with self.data.batch():
+            if ctx.guild.id not in self.data[attack]:
+                self.data[attack][ctx.guild.id] = []
+            self.data[attack][ctx.guild.id].append(target.id)
 
         await ctx.send(f"{target.mention} <3")
 
@@ -155,39 +197,57 @@ class Rude(CogWithData):
         return out
 
     def check_ratio(self, message: nextcord.Message):
-        pattern = re.compile(r'\b(?:ratio|ratiod|ratioed)\b', re.IGNORECASE)
-        return pattern.search(message.content) is not None
+        return _RATIO_PATTERN.search(message.content) is not None
 
+    async def handle_message(self, view: MessageView) -> bool:
+        """
+        :return: True if the message was silenced, so nothing else should respond to it
+        """
+        message = view.message
+        try:
+            if view.guild_id is not None:
+                if view.guild_id in self.data["silence"]:
+                    if view.author_id in self.data["silence"][view.guild_id]:
+                        try:
+                            await message.delete()
+                        except nextcord.Forbidden:
+                            await message.channel.send(self.get_silence_message(message))
+                        return True
+                if view.guild_id in self.data["mimic"]:
+                    if view.author_id in self.data["mimic"][view.guild_id]:
+                        await message.channel.send(self.spongebobify(message))
+                        return False
+                if view.guild_id in self.data["mock"]:
+                    if view.author_id in self.data["mock"][view.guild_id]:
+                        await message.channel.send("https://tenor.com/view/i-show-speed-dick-sucker-cock-gif-24582039")
+                        return False
+        except Exception as error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            logging.error("Error in rude.", exc_info=(type(error), error, error.__traceback__))
+        return False
 
-    @commands.Cog.listener()
-    async def on_message(self, message: nextcord.Message):
-        if message.author.id != self.bot.user.id:
-            try:
-                if message.guild is not None:
-                    if message.guild.id in self.data["silence"]:
-                        if message.author.id in self.data["silence"][message.guild.id]:
-                            try:
-                                await message.delete()
-                            except nextcord.Forbidden:
-                                await message.channel.send(self.get_silence_message(message))
-                            return
-                    if message.guild.id in self.data["mimic"]:
-                        if message.author.id in self.data["mimic"][message.guild.id]:
-                            await message.channel.send(self.spongebobify(message))
-                            return
-                    if message.guild.id in self.data["mock"]:
-                        if message.author.id in self.data["mock"][message.guild.id]:
-                            await message.channel.send("https://tenor.com/view/i-show-speed-dick-sucker-cock-gif-24582039")
-                            return
-                if self.check_ratio(message):
-                    if random() < self.counter_ratio_chance:
-                        sent_message = await message.reply("\@here let's ratio this bozo")
-                        await sent_message.add_reaction("⬆")
-                    else:
-                        await message.add_reaction("⬆")
-            except Exception as error:
-                traceback.print_exception(type(error), error, error.__traceback__)
-                logging.error("Error in rude.", exc_info=(type(error), error, error.__traceback__))
+    def _is_mimicked_or_mocked(self, view: MessageView) -> bool:
+        features = self.bot.message_pipeline.features
+        if view.guild_id is None or not features.has(view.guild_id, features.bit("rude")):
+            return False
+        for attack in ("mimic", "mock"):
+            if view.author_id in self.data.get(attack, {}).get(view.guild_id, []):
+                return True
+        return False
+
+    async def handle_ratio(self, view: MessageView):
+        message = view.message
+        try:
+            # Mimicking or mocking someone is reply enough
+            if self.check_ratio(message) and not self._is_mimicked_or_mocked(view):
+                if random() < self.counter_ratio_chance:
+                    sent_message = await message.reply("\@here let's ratio this bozo")
+                    await sent_message.add_reaction("⬆")
+                else:
+                    await message.add_reaction("⬆")
+        except Exception as error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            logging.error("Error in rude.", exc_info=(type(error), error, error.__traceback__))
 
     @commands.Cog.listener()
     async def on_typing(self, channel: nextcord.TextChannel, user: Union[nextcord.User, nextcord.Member], when):